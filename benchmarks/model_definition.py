@@ -0,0 +1,56 @@
+'''
+Measures the cost of defining many ``VersionedModel`` subclasses.
+
+The nested ``VersionModel`` classes are built lazily, so defining the models
+only pays for the top level classes. The cost of the nested classes is paid on
+first access, shown here by touching every ``_VersionModel`` afterwards::
+
+    python benchmarks/model_definition.py --models 500 --fields 10
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from peewee import CharField, IntegerField, SqliteDatabase  # noqa: E402
+
+from peewee_versioned import VersionedModel  # noqa: E402
+
+
+def define_models(count, field_count, database):
+    models = []
+    for i in range(count):
+        attrs = {'Meta': type('Meta', (object,), {'database': database})}
+        for j in range(field_count):
+            field_class = CharField if j % 2 else IntegerField
+            attrs['field_{}'.format(j)] = field_class(null=True)
+        models.append(type('Model{}'.format(i), (VersionedModel,), attrs))
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--models', type=int, default=300)
+    parser.add_argument('--fields', type=int, default=10)
+    args = parser.parse_args()
+
+    database = SqliteDatabase(':memory:')
+
+    started = time.time()
+    models = define_models(args.models, args.fields, database)
+    defined = time.time() - started
+
+    started = time.time()
+    for model in models:
+        model._VersionModel
+    built = time.time() - started
+
+    print('defining {} models with {} fields: {:.3f}s'.format(args.models, args.fields, defined))
+    print('building their VersionModels on first access: {:.3f}s'.format(built))
+    print('eager definition would have taken: {:.3f}s'.format(defined + built))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,3 @@
 from .peewee_versioned import VersionedModel
+from .cache import VersionCache
 from .migrate import migrate
@@ -0,0 +1,167 @@
+'''
+Creates the initial versions when an existing, populated model becomes a ``VersionedModel``.
+
+Without a version, the first ``save()`` of an existing row has nothing to
+finalize and ``version_id`` fails. :func:`backfill` creates the version table
+and writes a first version for every row with ``INSERT ... SELECT``, one
+primary key range at a time::
+
+    backfill(Person, chunk_size=10000, workers=4)
+
+Chunks skip rows that already have a version, so an interrupted backfill can
+simply be run again, optionally from ``start_id``. Where the database supports
+``SELECT ... FOR UPDATE`` each chunk locks its rows first, so a concurrent
+``save()`` waits for the chunk instead of writing a second first version.
+'''
+import multiprocessing
+
+from peewee import Param, SqliteDatabase, fn
+
+from .compression import compress_value, get_compressed_fields
+
+# Rows per INSERT when the values are compressed in Python
+INSERT_BATCH_SIZE = 100
+
+
+def _get_field_pairs(model):
+    '''
+    :return: list of (version field, live field) tuples to copy
+    '''
+    VersionModel = model._get_version_model()
+    pairs = []
+    for field in model._meta.sorted_fields:
+        if field is not model._meta.primary_key and field.name in VersionModel._meta.fields:
+            pairs.append((VersionModel._meta.fields[field.name], field))
+    return pairs
+
+
+def backfill_chunk(model, chunk_start, chunk_end, valid_from=None):
+    '''
+    Creates the first version of the rows of ``model`` with a primary key in ``[chunk_start, chunk_end)``
+    that don't have a version yet, in a single transaction.
+
+    :return: number of versions created
+    '''
+    VersionModel = model._get_version_model()
+    database = model._meta.database
+    pk = model._meta.primary_key
+    valid_from = valid_from or model._get_timestamp()
+
+    pairs = _get_field_pairs(model)
+    in_chunk = (pk >= chunk_start) & (pk < chunk_end)
+    versioned = (VersionModel
+                 .select(VersionModel._record_id)
+                 .where((VersionModel._record_id >= chunk_start) & (VersionModel._record_id < chunk_end)))
+
+    with database.atomic():
+        if database.for_update:
+            # Rows being saved concurrently are written by the time the lock is granted
+            list(model.select(pk).where(in_chunk).for_update().tuples())
+
+        if any(version_field.name in get_compressed_fields(VersionModel) for version_field, field in pairs):
+            return _backfill_compressed(model, pairs, in_chunk & ~(pk << versioned), valid_from)
+
+        query = (model
+                 .select(*([field for version_field, field in pairs] +
+                           [pk, pk, Param(1), Param(valid_from), Param(False)]))
+                 .where(in_chunk & ~(pk << versioned)))
+        fields = ([version_field for version_field, field in pairs] +
+                  [VersionModel._original_record, VersionModel._record_id, VersionModel._version_id,
+                   VersionModel._valid_from, VersionModel._deleted])
+        # The INSERT is the first write, so SQLite waits for other writers instead of failing
+        return database.execute_sql(*VersionModel.insert_from(fields, query).sql()).rowcount
+
+
+def _backfill_compressed(model, pairs, where, valid_from):
+    '''
+    Writes the first versions through Python, so the compressed fields are stored compressed.
+
+    :return: number of versions created
+    '''
+    VersionModel = model._get_version_model()
+    compressed = get_compressed_fields(VersionModel)
+    pk = model._meta.primary_key
+
+    rows = []
+    for values in model.select(*([field for version_field, field in pairs] + [pk])).where(where).tuples():
+        row = {'_original_record': values[-1], '_record_id': values[-1], '_version_id': 1,
+               '_valid_from': valid_from, '_deleted': False}
+        for (version_field, field), value in zip(pairs, values):
+            if version_field.name in compressed:
+                value = compress_value(version_field, value)
+            row[version_field.name] = value
+        rows.append(row)
+
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        VersionModel.insert_many(rows[start:start + INSERT_BATCH_SIZE]).execute()
+    return len(rows)
+
+
+def _backfill_chunk_worker(arguments):
+    model = arguments[0]
+    try:
+        return backfill_chunk(*arguments)
+    finally:
+        # Don't leave connections behind in the worker processes
+        if not model._meta.database.is_closed():
+            model._meta.database.close()
+
+
+def supports_parallel_writes(database):
+    '''
+    :return: ``True`` if several processes can write to ``database`` at the same time
+    '''
+    return not isinstance(database, SqliteDatabase)
+
+
+def backfill(model, chunk_size=10000, workers=1, start_id=None, progress=None):
+    '''
+    Creates the version table of ``model`` if needed and a first version for every row without one.
+
+    :param model: the ``VersionedModel`` subclass
+    :param int chunk_size: number of primary keys per chunk, each chunk is a transaction
+    :param int workers: number of worker processes running chunks in parallel. SQLite allows only one
+                        writer, so it always runs the chunks in this process.
+    :param start_id: first primary key to backfill, to resume after an interruption
+    :param progress: optional callable, called with ``(chunk_start, chunk_end, created)`` after each chunk
+    :return: number of versions created
+    '''
+    VersionModel = model._get_version_model()
+    database = model._meta.database
+    pk = model._meta.primary_key
+    VersionModel.create_table(fail_silently=True)
+
+    bounds = model.select(fn.MIN(pk), fn.MAX(pk))
+    if start_id is not None:
+        bounds = bounds.where(pk >= start_id)
+    low, high = bounds.tuples().get()
+    if low is None:
+        return 0
+
+    # Every version of the backfill starts at the same moment
+    valid_from = model._get_timestamp()
+    chunks = [(model, chunk_start, min(chunk_start + chunk_size, high + 1), valid_from)
+              for chunk_start in range(low, high + 1, chunk_size)]
+
+    created = 0
+    if workers > 1 and supports_parallel_writes(database):
+        # Workers open their own connections, they must not inherit ours
+        if not database.is_closed():
+            database.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.imap(_backfill_chunk_worker, chunks)
+            for (model, chunk_start, chunk_end, valid_from), count in zip(chunks, results):
+                created += count
+                if progress is not None:
+                    progress(chunk_start, chunk_end, count)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for model, chunk_start, chunk_end, valid_from in chunks:
+            count = backfill_chunk(model, chunk_start, chunk_end, valid_from)
+            created += count
+            if progress is not None:
+                progress(chunk_start, chunk_end, count)
+    return created
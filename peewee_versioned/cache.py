@@ -0,0 +1,111 @@
+'''
+Provides :class:`VersionCache`, a bounded cache for historical versions.
+
+Enable it with the ``version_cache`` option of a ``VersionedModel``'s ``Meta``::
+
+    class Person(VersionedModel):
+        name = CharField()
+
+        class Meta:
+            database = database
+            version_cache = VersionCache(maxsize=1024, ttl=300)
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionCache(object):
+    '''
+    A thread safe LRU cache of version rows with optional time-to-live eviction.
+
+    Entries are keyed by ``(model, record id, version id)`` and hold a copy of
+    the version's field data. Only closed versions are cached and they never
+    change. The one exception is a database reusing the id of a deleted record:
+    ``delete_instance()`` drops the versions of the record with :meth:`invalidate`,
+    other processes keep them until they expire, see ``ttl``.
+    '''
+
+    def __init__(self, maxsize=128, ttl=None, timer=time.time):
+        '''
+        :param int maxsize: maximum number of versions kept, the least recently used is evicted first
+        :param ttl: seconds an entry is kept, ``None`` keeps entries until they are evicted
+        :param timer: callable returning the current time in seconds
+        '''
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # (model, record id) -> keys of its cached versions
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        :return: a copy of the cached data for ``key`` or ``None``
+        '''
+        with self._lock:
+            try:
+                expires, data = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= self.timer():
+                self._forget(key)
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = (expires, data)
+            self.hits += 1
+            return dict(data)
+
+    def set(self, key, data):
+        expires = None if self.ttl is None else self.timer() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, dict(data))
+            if isinstance(key, tuple):
+                self._records.setdefault(key[:-1], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._forget(self._entries.popitem(last=False)[0])
+
+    def _forget(self, key):
+        '''
+        Removes ``key``, already popped from the entries, from the index of records
+        '''
+        if not isinstance(key, tuple):
+            return
+        keys = self._records.get(key[:-1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._records[key[:-1]]
+
+    def invalidate(self, model, record_id):
+        '''
+        Drops the cached versions of the record ``record_id`` of ``model``
+        '''
+        with self._lock:
+            for key in self._records.pop((model, record_id), ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._records.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        '''
+        :return: dict with the ``hits``, ``misses`` and ``size`` of the cache
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
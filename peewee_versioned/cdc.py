@@ -0,0 +1,273 @@
+'''
+Change data capture over the ``VersionModel`` tables.
+
+Every versioned write appends a row to a ``VersionModel`` table, so these
+tables already are an append-only change log ordered by ``_id``.
+:class:`ChangeFeed` tails one or more of them in batches and keeps a durable
+checkpoint per consumer and table::
+
+    feed = ChangeFeed('search-index', [Person, Document], batch_size=500)
+    for batch in feed:
+        for event in batch:
+            index(event.type, event.record_id, event.version)
+        feed.commit()
+
+Events of different tables are not ordered relative to each other.
+Rows are read in ``_id`` order. A missing ``_id`` may belong to a transaction
+that commits later, so a feed stops at it until the row shows up or the gap is
+older than ``gap_timeout``, after which it is treated as a rolled back
+transaction.
+'''
+import datetime
+import time
+from collections import namedtuple
+
+from peewee import CharField, IntegerField, Model
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+EVENT_TYPES = (INSERT, UPDATE, DELETE)
+
+_checkpoint_models = {}
+
+
+class ChangeEvent(namedtuple('ChangeEvent', ('type', 'model', 'record_id', 'version'))):
+    '''
+    A single change
+
+    * ``type``: one of ``'insert'``, ``'update'`` or ``'delete'``
+    * ``model``: the ``VersionedModel`` that changed
+    * ``record_id``: primary key of the changed record
+    * ``version``: the ``VersionModel`` row holding the state after the change
+    '''
+    __slots__ = ()
+
+
+class BackpressureError(RuntimeError):
+    '''
+    Raised by :meth:`ChangeFeed.poll` when too many events wait for :meth:`ChangeFeed.commit`
+    '''
+
+
+def get_checkpoint_model(database):
+    '''
+    :return: the model storing the checkpoints of ``database``
+    '''
+    key = id(database)
+    if key not in _checkpoint_models:
+        class ChangeFeedCheckpoint(Model):
+            consumer = CharField()
+            table = CharField()
+            last_id = IntegerField(default=0)
+
+            class Meta:
+                db_table = 'changefeedcheckpoint'
+                indexes = ((('consumer', 'table'), True),)
+
+        ChangeFeedCheckpoint._meta.database = database
+        _checkpoint_models[key] = ChangeFeedCheckpoint
+    return _checkpoint_models[key]
+
+
+def get_event_type(version):
+    '''
+    :return: the type of change that created ``version``
+    '''
+    return _get_event_type(version._deleted, version._version_id)
+
+
+def _get_event_type(deleted, version_id):
+    if deleted:
+        return DELETE
+    if version_id == 1:
+        return INSERT
+    return UPDATE
+
+
+class ChangeFeed(object):
+    '''
+    Tails the ``VersionModel`` tables of ``models``.
+
+    :param str consumer: name of the consumer, checkpoints are stored per consumer
+    :param models: ``VersionedModel`` subclasses to follow
+    :param int batch_size: maximum number of events returned by :meth:`poll`
+    :param events: types of events to return, defaults to all of them
+    :param max_pending: maximum number of polled events waiting for :meth:`commit`
+                        before :meth:`poll` raises :class:`BackpressureError`.
+                        ``None`` disables the limit.
+    :param database: database holding the checkpoints, defaults to the database of the first model
+    :param gap_timeout: seconds to wait for a missing ``_id`` before skipping it, ``0`` never waits.
+                        A gap is skipped right away when the rows after it are older than that.
+    '''
+
+    def __init__(self, consumer, models, batch_size=1000, events=EVENT_TYPES,
+                 max_pending=None, database=None, gap_timeout=60):
+        if not models:
+            raise ValueError('ChangeFeed needs at least one model')
+        for event_type in events:
+            if event_type not in EVENT_TYPES:
+                raise ValueError('Unknown event type {}'.format(event_type))
+        self.consumer = consumer
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.events = frozenset(events)
+        self.max_pending = max_pending
+        self.gap_timeout = gap_timeout
+        self.Checkpoint = get_checkpoint_model(database or self.models[0]._meta.database)
+        self.Checkpoint.create_table(fail_silently=True)
+
+        self._committed = self._load_checkpoints()
+        self._positions = dict(self._committed)
+        self._pending = 0
+        # (table, missing ``_id``) -> time it was first seen
+        self._gaps = {}
+        # index of the model polled first
+        self._first = 0
+
+    def _load_checkpoints(self):
+        Checkpoint = self.Checkpoint
+        tables = [model._get_version_model()._meta.db_table for model in self.models]
+        positions = dict((table, 0) for table in tables)
+        query = (Checkpoint
+                 .select()
+                 .where((Checkpoint.consumer == self.consumer) &
+                        (Checkpoint.table << tables)))
+        for checkpoint in query:
+            positions[checkpoint.table] = checkpoint.last_id
+        return positions
+
+    def _gap_expired(self, model, table, missing_id, next_valid_from):
+        '''
+        :return: ``True`` if the missing ``_id`` can be skipped
+        '''
+        key = (table, missing_id)
+        now = time.time()
+        first_seen = self._gaps.setdefault(key, now)
+        # The transaction holding the missing ``_id`` started before the next row was written
+        oldest = model._get_timestamp() - datetime.timedelta(seconds=self.gap_timeout)
+        if now - first_seen >= self.gap_timeout or next_valid_from <= oldest:
+            del self._gaps[key]
+            return True
+        return False
+
+    def _poll_model(self, model, limit):
+        '''
+        Reads up to ``limit`` events of ``model`` after its position, up to the first gap in ``_id`` that
+        may still be filled.
+
+        :return: list of :class:`ChangeEvent`
+        '''
+        VersionModel = model._get_version_model()
+        table = VersionModel._meta.db_table
+        position = self._positions[table]
+
+        events = []
+        while len(events) < limit:
+            # Only the columns needed to find gaps and filter events
+            rows = list(VersionModel
+                        .select(VersionModel._id, VersionModel._deleted, VersionModel._version_id,
+                                VersionModel._valid_from)
+                        .where(VersionModel._id > position)
+                        .order_by(VersionModel._id)
+                        .limit(self.batch_size)
+                        .tuples())
+            ids = []
+            blocked = False
+            for _id, deleted, version_id, valid_from in rows:
+                if _id != position + 1 and not self._gap_expired(model, table, position + 1, valid_from):
+                    blocked = True
+                    break
+                position = _id
+                if _get_event_type(deleted, version_id) in self.events:
+                    ids.append(_id)
+                    if len(events) + len(ids) == limit:
+                        break
+
+            if ids:
+                versions = VersionModel.select().where(VersionModel._id << ids).order_by(VersionModel._id)
+                for version in versions:
+                    # ``_original_record_id`` is lost on delete, versions written before ``_record_id`` lack it
+                    record_id = version._record_id
+                    if record_id is None:
+                        record_id = version._original_record_id
+                    events.append(ChangeEvent(get_event_type(version), model, record_id, version))
+            self._positions[table] = position
+            if blocked or len(rows) < self.batch_size:
+                break
+        return events
+
+    def poll(self):
+        '''
+        Reads the next batch of events after the events already returned.
+
+        Every poll starts with the next model, so a model with a large backlog doesn't starve the others.
+
+        :return: list of :class:`ChangeEvent`, empty when the consumer has caught up
+        :raises BackpressureError: when more than ``max_pending`` events are not committed
+        '''
+        if self.max_pending is not None and self._pending >= self.max_pending:
+            raise BackpressureError('{} events are waiting to be committed'.format(self._pending))
+
+        models = self.models[self._first:] + self.models[:self._first]
+        self._first = (self._first + 1) % len(self.models)
+
+        batch = []
+        for model in models:
+            remaining = self.batch_size - len(batch)
+            if remaining <= 0:
+                break
+            batch.extend(self._poll_model(model, remaining))
+
+        self._pending += len(batch)
+        return batch
+
+    def commit(self):
+        '''
+        Stores the position of the events returned by :meth:`poll` so far.
+        '''
+        Checkpoint = self.Checkpoint
+        with Checkpoint._meta.database.atomic():
+            for table, position in self._positions.items():
+                if self._committed.get(table) == position:
+                    continue
+                updated = (Checkpoint
+                           .update(last_id=position)
+                           .where((Checkpoint.consumer == self.consumer) &
+                                  (Checkpoint.table == table))
+                           .execute())
+                if not updated:
+                    Checkpoint.create(consumer=self.consumer, table=table, last_id=position)
+        self._committed = dict(self._positions)
+        self._pending = 0
+
+    def rollback(self):
+        '''
+        Forgets the events returned by :meth:`poll` since the last :meth:`commit`,
+        the next :meth:`poll` returns them again.
+        '''
+        self._positions = dict(self._committed)
+        self._pending = 0
+
+    def __iter__(self):
+        '''
+        Yields batches until the consumer has caught up.
+        '''
+        while True:
+            batch = self.poll()
+            if not batch:
+                return
+            yield batch
+
+    def follow(self, poll_interval=1.0, stop=None):
+        '''
+        Yields batches forever, sleeping ``poll_interval`` seconds when the consumer has caught up.
+
+        :param stop: optional callable, following ends once it returns ``True``
+        '''
+        while stop is None or not stop():
+            batch = self.poll()
+            if batch:
+                yield batch
+            else:
+                time.sleep(poll_interval)
@@ -0,0 +1,234 @@
+'''
+Consistency checks for the ``VersionModel`` tables.
+
+:func:`check` looks for the following problems with one aggregate query each:
+
+* ``multiple_current``: records with more than one current version (``_valid_until`` is ``NULL``)
+* ``version_gaps``: records whose ``_version_id``'s are not exactly 1, 2, 3...
+* ``missing_version``: rows of the live table without a current version
+* ``orphaned``: current versions, not deleted, of records missing from the live table.
+  Not repaired: these records were removed without ``delete_instance()``, restore them with
+  :func:`peewee_versioned.recovery.rebuild` or delete them properly
+* ``unlinked``: current versions, not deleted, without a ``_record_id``
+* ``invalid_range``: versions with ``_valid_until`` before ``_valid_from``
+
+::
+
+    for violation in check([Person, Document], repair=True):
+        print(violation.model, violation.check, violation.count, violation.sample_ids)
+'''
+from collections import namedtuple
+
+from peewee import fn
+
+MULTIPLE_CURRENT = 'multiple_current'
+VERSION_GAPS = 'version_gaps'
+MISSING_VERSION = 'missing_version'
+ORPHANED = 'orphaned'
+UNLINKED = 'unlinked'
+INVALID_RANGE = 'invalid_range'
+CHECKS = (MULTIPLE_CURRENT, VERSION_GAPS, MISSING_VERSION, ORPHANED, UNLINKED, INVALID_RANGE)
+
+
+class Violation(namedtuple('Violation', ('model', 'check', 'count', 'sample_ids', 'repaired'))):
+    '''
+    A problem found by :func:`check`
+
+    * ``model``: the ``VersionedModel`` checked
+    * ``check``: name of the check, one of :data:`CHECKS`
+    * ``count``: number of violating records, or version rows for ``unlinked`` and ``invalid_range``
+    * ``sample_ids``: up to ``sample_size`` record ids, or version ``_id``'s for ``unlinked`` and ``invalid_range``
+    * ``repaired``: number of records or rows repaired
+    '''
+    __slots__ = ()
+
+
+def _current(VersionModel):
+    return VersionModel._valid_until.is_null()
+
+
+def _not_reused(VersionModel):
+    '''
+    Condition excluding the versions of earlier records with the same id.
+
+    A database can reuse the id of a deleted record, the versions of the new record then
+    follow the tombstone of the old one, which stays current. Versions up to such a
+    tombstone belong to the old record and are left out, like :meth:`VersionedModel.deleted` does.
+    '''
+    Tombstone = VersionModel.alias()
+    Later = VersionModel.alias()
+    later = Later.select(Later._id).where((Later._record_id == Tombstone._record_id) & (Later._id > Tombstone._id))
+    reused = (Tombstone
+              .select(Tombstone._id)
+              .where((Tombstone._record_id == VersionModel._record_id) &
+                     (Tombstone._id >= VersionModel._id) &
+                     (Tombstone._deleted == True) &
+                     Tombstone._valid_until.is_null() &
+                     fn.EXISTS(later)))
+    return ~fn.EXISTS(reused)
+
+
+def _violations(model, name):
+    '''
+    :return: query selecting the ids violating check ``name``
+    '''
+    VersionModel = model._get_version_model()
+    record_id = VersionModel._record_id
+    pk = model._meta.primary_key
+
+    if name == MULTIPLE_CURRENT:
+        return (VersionModel
+                .select(record_id)
+                .where(_current(VersionModel) & record_id.is_null(False) & _not_reused(VersionModel))
+                .group_by(record_id)
+                .having(fn.COUNT(VersionModel._id) > 1))
+    if name == VERSION_GAPS:
+        return (VersionModel
+                .select(record_id)
+                .where(record_id.is_null(False) & _not_reused(VersionModel))
+                .group_by(record_id)
+                .having((fn.MIN(VersionModel._version_id) != 1) |
+                        (fn.MAX(VersionModel._version_id) != fn.COUNT(VersionModel._id)) |
+                        (fn.COUNT(fn.DISTINCT(VersionModel._version_id)) != fn.COUNT(VersionModel._id))))
+    if name == MISSING_VERSION:
+        current = VersionModel.select(record_id).where(_current(VersionModel) & record_id.is_null(False))
+        return model.select(pk).where(~(pk << current))
+    if name == ORPHANED:
+        return (VersionModel
+                .select(record_id)
+                .where(_current(VersionModel) &
+                       (VersionModel._deleted == False) &
+                       record_id.is_null(False) &
+                       ~(record_id << model.select(pk)))
+                .group_by(record_id))
+    if name == UNLINKED:
+        return (VersionModel
+                .select(VersionModel._id)
+                .where(_current(VersionModel) &
+                       (VersionModel._deleted == False) &
+                       record_id.is_null()))
+    if name == INVALID_RANGE:
+        return (VersionModel
+                .select(VersionModel._id)
+                .where(VersionModel._valid_until < VersionModel._valid_from))
+    raise ValueError('Unknown check {}'.format(name))
+
+
+def _repair_multiple_current(model, ids):
+    '''
+    Closes all current versions but the last one, each ends where the next one starts
+    '''
+    VersionModel = model._get_version_model()
+    versions = (VersionModel
+                .select()
+                .where(_current(VersionModel) & (VersionModel._record_id << ids) & _not_reused(VersionModel))
+                .order_by(VersionModel._record_id, VersionModel._version_id, VersionModel._id))
+    previous = None
+    for version in versions:
+        if previous is not None and previous._record_id == version._record_id:
+            previous._valid_until = version._valid_from
+            previous.save()
+        previous = version
+
+
+def _repair_version_gaps(model, ids):
+    '''
+    Renumbers the versions of each record 1, 2, 3... in their current order
+    '''
+    VersionModel = model._get_version_model()
+    # Read all rows first, the updates move them in the index the query walks
+    versions = list(VersionModel
+                    .select(VersionModel._id, VersionModel._record_id, VersionModel._version_id)
+                    .where((VersionModel._record_id << ids) & _not_reused(VersionModel))
+                    .order_by(VersionModel._record_id, VersionModel._version_id, VersionModel._id))
+    record_id = None
+    for version in versions:
+        if version._record_id != record_id:
+            record_id = version._record_id
+            number = 0
+        number += 1
+        if version._version_id != number:
+            (VersionModel
+             .update(_version_id=number)
+             .where(VersionModel._id == version._id)
+             .execute())
+
+
+def _repair_missing_version(model, ids):
+    '''
+    Creates a current version from the live row
+    '''
+    pk = model._meta.primary_key
+    for record in model.select().where(pk << ids):
+        record._create_new_version()
+
+
+def _repair_invalid_range(model, ids):
+    '''
+    Shrinks the validity of the versions to nothing
+    '''
+    VersionModel = model._get_version_model()
+    (VersionModel
+     .update(_valid_until=VersionModel._valid_from)
+     .where(VersionModel._id << ids)
+     .execute())
+
+
+_REPAIRS = {
+    MULTIPLE_CURRENT: _repair_multiple_current,
+    VERSION_GAPS: _repair_version_gaps,
+    MISSING_VERSION: _repair_missing_version,
+    INVALID_RANGE: _repair_invalid_range,
+}
+
+
+def _repair(model, name, batch_size):
+    '''
+    Repairs the violations of check ``name`` ``batch_size`` ids per transaction
+
+    :return: number of repaired ids
+    '''
+    repair = _REPAIRS.get(name)
+    if repair is None:
+        return 0
+    database = model._meta.database
+    repaired = 0
+    previous_ids = None
+    while True:
+        ids = [row[0] for row in _violations(model, name).limit(batch_size).tuples()]
+        # Stop when nothing is left, or when the repair can't fix what is left
+        if not ids or ids == previous_ids:
+            return repaired
+        with database.atomic():
+            repair(model, ids)
+        repaired += len(ids)
+        previous_ids = ids
+
+
+def check(models, checks=CHECKS, sample_size=5, repair=False, batch_size=1000):
+    '''
+    Checks the version tables of ``models`` for inconsistencies.
+
+    :param models: ``VersionedModel`` subclasses to check
+    :param checks: names of the checks to run, defaults to all of them
+    :param int sample_size: maximum number of ids reported per violation
+    :param bool repair: fix the violations, ``orphaned`` records and ``unlinked`` versions are only reported
+    :param int batch_size: number of ids repaired per transaction
+    :return: list of :class:`Violation`, one for each check that found a problem
+    '''
+    violations = []
+    for model in models:
+        for name in checks:
+            query = _violations(model, name)
+            count = query.count()
+            if not count:
+                continue
+            sample_ids = [row[0] for row in query.limit(sample_size).tuples()]
+            repaired = _repair(model, name, batch_size) if repair else 0
+            violations.append(Violation(model, name, count, sample_ids, repaired))
+
+            # Cached versions may have been changed by the repair
+            cache = model._get_version_cache()
+            if repaired and cache is not None:
+                cache.clear()
+    return violations
@@ -0,0 +1,198 @@
+'''
+Transparent compression of large columns in ``VersionModel`` rows.
+
+Compression is enabled per field with the ``compressed_fields`` option of a
+``VersionedModel``'s ``Meta``. It maps field names to the size in bytes from
+which values are compressed::
+
+    class Document(VersionedModel):
+        title = CharField()
+        body = TextField()
+
+        class Meta:
+            database = database
+            compressed_fields = {'body': 1024}
+
+Only the nested ``VersionModel`` stores compressed values. Attribute access
+on a version decompresses the value, so ``revert()`` and friends keep working.
+'''
+import base64
+import binascii
+import zlib
+
+import six
+from peewee import BlobField, FieldDescriptor
+
+# Prefix of every compressed value
+MARKER = 'zlib:'
+BINARY_MARKER = MARKER.encode('ascii')
+
+
+def _is_binary(field):
+    return isinstance(field, BlobField)
+
+
+def compress_value(field, value):
+    '''
+    :param field: the ``peewee.Field`` ``value`` belongs to
+    :param value: the uncompressed value
+    :return: the value as it should be stored, compressed or not
+    '''
+    if value is None:
+        return value
+    threshold = field.model_class._meta.compressed_fields[field.name]
+
+    if _is_binary(field):
+        raw = bytes(value)
+        # Values that look compressed are always compressed to stay unambiguous
+        if len(raw) < threshold and not raw.startswith(BINARY_MARKER):
+            return value
+        compressed = BINARY_MARKER + zlib.compress(raw)
+        if len(compressed) >= len(raw) and not raw.startswith(BINARY_MARKER):
+            return value
+        return compressed
+
+    if isinstance(value, six.text_type):
+        raw = value.encode('utf-8')
+    else:
+        raw = value
+    if len(raw) < threshold and not value.startswith(MARKER):
+        return value
+    compressed = MARKER + base64.b64encode(zlib.compress(raw)).decode('ascii')
+    if len(compressed) >= len(raw) and not value.startswith(MARKER):
+        return value
+    return compressed
+
+
+def _decompress(field, value):
+    '''
+    :raise ValueError: if ``value`` is not a compressed value
+    '''
+    if value is None:
+        raise ValueError('not compressed')
+    if _is_binary(field):
+        raw = bytes(value)
+        if not raw.startswith(BINARY_MARKER):
+            raise ValueError('not compressed')
+        try:
+            return zlib.decompress(raw[len(BINARY_MARKER):])
+        except zlib.error as e:
+            raise ValueError(str(e))
+    if not isinstance(value, six.string_types) or not value.startswith(MARKER):
+        raise ValueError('not compressed')
+    try:
+        return zlib.decompress(base64.b64decode(value[len(MARKER):])).decode('utf-8')
+    except (binascii.Error, zlib.error, TypeError, UnicodeError) as e:
+        raise ValueError(str(e))
+
+
+def is_compressed(field, value):
+    '''
+    Values stored before compression was enabled may start with the marker too,
+    only those that also decompress count as compressed.
+
+    :return: ``True`` if ``value`` is a stored, compressed value
+    '''
+    try:
+        _decompress(field, value)
+    except ValueError:
+        return False
+    return True
+
+
+def decompress_value(field, value):
+    '''
+    :param field: the ``peewee.Field`` ``value`` belongs to
+    :param value: the stored value
+    :return: the uncompressed value, ``value`` itself if it is not compressed
+    '''
+    try:
+        return _decompress(field, value)
+    except ValueError:
+        return value
+
+
+class CompressedFieldDescriptor(FieldDescriptor):
+    '''
+    Decompresses the stored value on access. Assigned values are stored as given.
+    '''
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None:
+            return decompress_value(self.field, instance._data.get(self.att_name))
+        return self.field
+
+
+def get_compressed_fields(model):
+    '''
+    :return: dict of field name -> threshold in bytes for ``model``
+    '''
+    return getattr(model._meta, 'compressed_fields', None) or {}
+
+
+def install(version_model):
+    '''
+    Replaces the field descriptors of the compressed fields of ``version_model``
+    '''
+    for name in get_compressed_fields(version_model):
+        if name not in version_model._meta.fields:
+            raise ValueError('compressed_fields: {} has no field {}'
+                             .format(version_model.__name__, name))
+        setattr(version_model, name, CompressedFieldDescriptor(version_model._meta.fields[name]))
+
+
+def compress_version(version):
+    '''
+    Compresses the compressed fields of an unsaved ``version`` in place
+    '''
+    fields = version._meta.fields
+    for name in get_compressed_fields(version):
+        version._data[name] = compress_value(fields[name], version._data.get(name))
+
+
+def compress_history(model, batch_size=1000):
+    '''
+    Compresses the existing history of ``model`` according to its ``compressed_fields``.
+
+    Rows are processed in batches of ``batch_size`` in order of ``_id``, each batch
+    in its own transaction, so the function can be interrupted and run again.
+    Uncompressed values starting with the marker are compressed as well, so they
+    read back unchanged.
+
+    :param model: a ``VersionedModel`` subclass
+    :return: the number of version rows that were updated
+    '''
+    VersionModel = model._get_version_model()
+    names = list(get_compressed_fields(VersionModel))
+    if not names:
+        return 0
+    fields = [VersionModel._meta.fields[name] for name in names]
+    database = VersionModel._meta.database
+
+    updated = 0
+    last_id = None
+    while True:
+        query = (VersionModel
+                 .select(VersionModel._id, *fields)
+                 .order_by(VersionModel._id)
+                 .limit(batch_size))
+        if last_id is not None:
+            query = query.where(VersionModel._id > last_id)
+        rows = list(query.naive())
+        if not rows:
+            return updated
+
+        with database.atomic():
+            for row in rows:
+                changes = {}
+                for field in fields:
+                    value = row._data.get(field.name)
+                    if is_compressed(field, value):
+                        continue
+                    compressed = compress_value(field, value)
+                    if compressed is not value:
+                        changes[field] = compressed
+                if changes:
+                    VersionModel.update(changes).where(VersionModel._id == row._id).execute()
+                    updated += 1
+        last_id = rows[-1]._id
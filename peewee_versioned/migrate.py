@@ -1,6 +1,8 @@
+from collections import namedtuple
 from copy import copy
 
-from peewee import ForeignKeyField
+from peewee import (SQL, ForeignKeyField, MySQLDatabase, OperationalError, PostgresqlDatabase, SqliteDatabase,
+                    fn)
 
 from playhouse.migrate import Operation
 from playhouse.reflection import Introspector
@@ -64,104 +66,288 @@ def _rename_table(operation, migrator, introspector, old_name, new_name):
         version.save() 
 
 
+class PlannedOperation(namedtuple('PlannedOperation', ('method', 'table', 'args', 'estimated_rows'))):
+    '''
+    A step of a migration, as returned by :func:`migrate` with ``dry_run=True``
+
+    * ``method``: name of the migrator method, or ``relink`` for re-linking the versions of a renamed table
+    * ``table``: the table the step changes
+    * ``args``: the arguments of the migrator method
+    * ``estimated_rows``: estimated rows of ``table``, all of which a rewrite of the table touches
+    '''
+    __slots__ = ()
+
+
+def estimate_rows(model):
+    '''
+    Estimates the number of rows in the table of ``model`` without counting them.
+
+    Postgres and MySQL keep an estimate in their statistics, as does SQLite once the table was analyzed.
+    Otherwise SQLite uses the highest ``rowid``, which is exact unless rows were deleted.
+
+    :return: the estimated number of rows, ``None`` if no estimate is available
+    '''
+    return _estimate_table_rows(model._meta.database, model._meta.db_table)
+
+
+def _estimate_table_rows(database, table):
+    if isinstance(database, PostgresqlDatabase):
+        row = _fetch_estimate(database, 'SELECT reltuples FROM pg_class WHERE relname = %s', (table,))
+    elif isinstance(database, MySQLDatabase):
+        row = _fetch_estimate(database,
+                              'SELECT table_rows FROM information_schema.tables '
+                              'WHERE table_schema = DATABASE() AND table_name = %s', (table,))
+    elif isinstance(database, SqliteDatabase):
+        # Only exists after ANALYZE, the first number of ``stat`` is the number of rows
+        row = _fetch_estimate(database, 'SELECT stat FROM sqlite_stat1 WHERE tbl = ?', (table,))
+        if row is None:
+            row = _fetch_estimate(database, 'SELECT COALESCE(MAX(rowid), 0) FROM "{}"'.format(table))
+    else:
+        row = None
+    if row is not None:
+        rows = int(str(row[0]).split()[0])
+        # Postgres reports -1 for tables that were never analyzed
+        if rows >= 0:
+            return rows
+    return None
+
+
+def _fetch_estimate(database, sql, params=None):
+    '''
+    :return: the first row of ``sql``, ``None`` if there is none or the statistics don't exist
+    '''
+    try:
+        row = database.execute_sql(sql, params).fetchone()
+    except OperationalError:
+        return None
+    if row is None or row[0] is None:
+        return None
+    return row
+
+
+def _get_rows(models, table, estimate):
+    if not estimate or table not in models:
+        return None
+    return estimate_rows(models[table])
+
+
+def _plan_rename_table(models, old_name, new_name, estimate):
+    '''
+    :return: the steps :func:`_rename_table` runs
+    '''
+    version_old_name = old_name + 'version'
+    version_new_name = new_name + 'version'
+    rows = _get_rows(models, old_name, estimate)
+    version_rows = _get_rows(models, version_old_name, estimate)
+    return [
+        PlannedOperation('drop_column', version_old_name, (version_old_name, '_original_record_id'), version_rows),
+        PlannedOperation('rename_table', old_name, (old_name, new_name), rows),
+        PlannedOperation('rename_table', version_old_name, (version_old_name, version_new_name), version_rows),
+        PlannedOperation('add_column', version_new_name, (version_new_name, '_original_record_id'), version_rows),
+        PlannedOperation('relink', version_new_name, (version_new_name, new_name), version_rows),
+    ]
+
+
+def _plan_operation(operation, estimate=False):
+    '''
+    Works out what running ``operation`` on a table and its version table takes.
+
+    :param bool estimate: estimate the rows of the steps, otherwise ``estimated_rows`` is ``None``
+    :return: ``(steps, run)``, the list of :class:`PlannedOperation` and a function running them
+    '''
+    migrator = operation.migrator
+    database = operation.migrator.database
+    method = operation.method
+    args = list(copy(operation.args))
+    kwargs = operation.kwargs.copy()
+
+    # potential arguments to be used with the nested class
+    version_args = copy(args)
+    version_kwargs = kwargs.copy()
+
+    # Get the table name of the operation
+    # Update version args/kwargs
+    if method == 'rename_table':
+        table = kwargs.get('old_name', None)
+        if table is not None:
+            version_kwargs['old_name'] = table + 'version'
+    else:
+        table = kwargs.get('table', None)
+        if table is not None:
+            version_kwargs['table'] = table + 'version'
+    if table is None:
+        table = args[0]
+        version_args[0] = table + 'version'
+
+    # Exit early for NOOP methods, without introspecting the schema
+    if method in NOOP_OPERATIONS:
+        rows = _estimate_table_rows(database, table) if estimate else None
+        return [PlannedOperation(method, table, tuple(args), rows)], operation.run
+
+    # Read models from the database and cache
+    introspector = Introspector.from_database(database)
+    models = introspector.generate_models(skip_invalid=True)
+
+    steps = [PlannedOperation(method, table, tuple(args), _get_rows(models, table, estimate))]
+
+    # Test if the model has a version model associated with it
+    version_name = table + 'version'
+    if version_name not in models:
+        return steps, operation.run
+
+    version_model = models[version_name]
+    version_fields = version_model._meta.fields
+
+    # Handle special cases first
+    if method == 'add_column':
+        # Don't add foreign keys
+        field = kwargs.get('field', None)
+        if field is None:
+            field = args[2]
+        if isinstance(field, ForeignKeyField):
+            return steps, operation.run
+    elif method == 'drop_column':
+        column_name = kwargs.get('column_name', None)
+        if column_name is None:
+            column_name = args[1]
+        if column_name not in version_fields:
+            return steps, operation.run
+    elif method == 'rename_column':
+        old_name = kwargs.get('old_name', None)
+        if old_name is None:
+            old_name = args[1]
+        if old_name not in version_fields:
+            return steps, operation.run
+    elif method in ('add_not_null', 'drop_not_null'):
+        column = kwargs.get('column', None)
+        if column is None:
+            column = args[1]
+        if column not in version_fields:
+            return steps, operation.run
+    elif method == 'rename_table':
+        old_name = kwargs.get('old_name', None)
+        if old_name is None:
+            old_name = args[0]
+        new_name = kwargs.get('new_name', None)
+        if new_name is None:
+            new_name = version_args[1]
+
+        def run():
+            _rename_table(operation, migrator, introspector, old_name, new_name)
+        return _plan_rename_table(models, old_name, new_name, estimate), run
+
+    # I guess we have a valid operation, so we will create and run it for the nested verion model
+    version_operation = Operation(migrator, method, *version_args, **version_kwargs)
+    steps.append(PlannedOperation(method, version_name, tuple(version_args),
+                                  _get_rows(models, version_name, estimate)))
+
+    def run():
+        operation.run()
+        version_operation.run()
+    return steps, run
+
+
 def migrate(*operations, **kwargs):
     '''
     A wraper around :func:playhouse.migrate.migrate:
     
     This method ensures that the same migrations are performed on nested :class:peewee_versioned.VersionedModel:'s
+
+    :param bool dry_run: don't run anything, instead return the list of :class:`PlannedOperation` that would be
+                         run, with estimated rows. Each operation is planned against the current schema, so an
+                         operation depending on an earlier one in the same call may be planned differently
+                         from how it would run.
     '''
-    
-    # Collect nested classes
+    dry_run = kwargs.pop('dry_run', False)
+
+    plan = []
     for operation in operations:
-        migrator = operation.migrator
-        database = operation.migrator.database
-        method = operation.method
-        args = list(copy(operation.args))
-        kwargs = operation.kwargs.copy()
-        
-        # Exit early for NOOP methods
-        if method in NOOP_OPERATIONS:
-            operation.run()
-            continue
-        
-        # potential arguments to be used with the nested class
-        version_args = copy(args)
-        version_kwargs = kwargs.copy()
-        
-        # potential operation to run on the nested class
-        version_operation = None
-        
-        # Get the table name of the operation
-        # Update version args/kwargs
-        if method == 'rename_table':
-            table = kwargs.get('old_name', None)
-            if table is not None:
-                version_kwargs['old_name'] = table + 'version'
+        steps, run = _plan_operation(operation, estimate=dry_run)
+        if dry_run:
+            plan.extend(steps)
         else:
-            table = kwargs.get('table', None)
-            if table is not None:
-                version_kwargs['table'] = table + 'version'
-        if table is None:
-            table = args[0]
-            version_args[0] = table + 'version'
-        
-        # Read models from the database and cache
-        introspector = Introspector.from_database(database)
-        models = introspector.generate_models(skip_invalid=True)
-        
-        # Test if the model has a version model associated with it
-        version_name = table + 'version'
-        if version_name in models:
-            version_model = models[version_name]
-            version_fields = version_model._meta.fields
-            
-            # Handle special cases first
-            if method == 'add_column':
-                # Don't add foreign keys
-                field = kwargs.get('field', None)
-                if field is None:
-                    field = args[2]
-                if isinstance(field, ForeignKeyField):
-                    operation.run()
-                    continue
-            elif method == 'drop_column':
-                column_name = kwargs.get('column_name', None)
-                if column_name is None:
-                    column_name = args[1]
-                if column_name not in version_fields:
-                    operation.run()
-                    continue
-            elif method == 'rename_column':
-                old_name = kwargs.get('old_name', None)
-                if old_name is None:
-                    old_name = args[1]
-                if old_name not in version_fields:
-                    operation.run()
-                    continue
-            elif method in ('add_not_null', 'drop_not_null'):
-                column = kwargs.get('column', None)
-                if column is None:
-                    column = args[1]
-                if column not in version_fields:
-                    operation.run()
-                    continue
-            elif method == 'rename_table':
-                old_name = kwargs.get('old_name', None)
-                if old_name is None:
-                    old_name = args[0]
-                new_name = kwargs.get('new_name', None)
-                if new_name is None:
-                    new_name = version_args[1]
-                
-                _rename_table(operation, migrator, introspector, old_name, new_name)
-                continue
-                
-                    
-            # I guess we have a valid operation, so we will create and run it for the nested verion model
-            version_operation = Operation(migrator, method, *version_args, **version_kwargs)
-            
-        
-        # Run the operations
-        operation.run()
-        if version_operation is not None:
-            version_operation.run()
+            run()
+    if dry_run:
+        return plan
+
+
+def _shift_datetime(field, offset):
+    '''
+    :return: SQL expression adding the :class:`datetime.timedelta` ``offset`` to the datetime column ``field``
+    '''
+    database = field.model_class._meta.database
+    seconds = offset.days * 86400 + offset.seconds
+    microseconds = seconds * 1000000 + offset.microseconds
+    if isinstance(database, PostgresqlDatabase):
+        return field + SQL("INTERVAL '{:d} microseconds'".format(microseconds))
+    if isinstance(database, MySQLDatabase):
+        return fn.TIMESTAMPADD(SQL('MICROSECOND'), microseconds, field)
+    if offset.microseconds:
+        raise ValueError('SQLite can only shift datetimes by whole seconds')
+    # SQLite stores text, the fraction of the second is kept as it is
+    return (fn.strftime('%Y-%m-%d %H:%M:%S', field, '{:+d} seconds'.format(seconds))
+            .concat(fn.substr(field, 20)))
+
+
+def normalize_timestamps(model, valid_from_offset=None, batch_size=1000):
+    '''
+    Normalizes the ``_valid_from`` and ``_valid_until`` of existing versions of ``model``.
+
+    Older releases stamped ``_valid_from`` in local time and ``_valid_until`` in UTC with separate clock reads,
+    leaving overlaps or gaps between versions. This function:
+
+    * adds ``valid_from_offset`` (a :class:`datetime.timedelta`, eg the UTC offset of the server that wrote
+      the versions) to every ``_valid_from``, if given
+    * sets the ``_valid_until`` of each version to the ``_valid_from`` of the next version of the same record
+
+    The shift is a single ``UPDATE``: an interrupted run changes nothing, a completed run must not be repeated.
+    The versions are then chained ``batch_size`` at a time, each batch in its own transaction. Chaining can
+    simply be run again.
+
+    :return: number of updated versions
+    '''
+    VersionModel = model._get_version_model()
+    database = VersionModel._meta.database
+    record_id = VersionModel._record_id
+    updated = 0
+
+    # Shift ``_valid_from`` to UTC in a single statement, so it is applied to all versions or none
+    if valid_from_offset:
+        updated = (VersionModel
+                   .update(_valid_from=_shift_datetime(VersionModel._valid_from, valid_from_offset))
+                   .execute())
+
+    # Chain the versions of each record, walking them in (record, _version_id) order
+    previous = None
+    last_key = None
+    while True:
+        query = (VersionModel
+                 .select(VersionModel._id, record_id, VersionModel._version_id,
+                         VersionModel._valid_from, VersionModel._valid_until)
+                 .where(record_id.is_null(False))
+                 .order_by(record_id, VersionModel._version_id)
+                 .limit(batch_size))
+        if last_key is not None:
+            query = query.where((record_id > last_key[0]) |
+                                ((record_id == last_key[0]) & (VersionModel._version_id > last_key[1])))
+        versions = list(query)
+        if not versions:
+            break
+        with database.atomic():
+            for version in versions:
+                if (previous is not None and
+                        previous._record_id == version._record_id and
+                        previous._valid_until != version._valid_from):
+                    (VersionModel
+                     .update(_valid_until=version._valid_from)
+                     .where(VersionModel._id == previous._id)
+                     .execute())
+                    if not valid_from_offset:
+                        updated += 1
+                previous = version
+        last_key = (previous._record_id, previous._version_id)
+
+    cache = model._get_version_cache()
+    if cache is not None:
+        cache.clear()
+    return updated
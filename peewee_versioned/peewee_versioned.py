@@ -3,10 +3,48 @@ Provides a subclass of peewee Module ``VersionModule`` that automatically
 adds a *_versions class and connects it to the proper signals
 '''
 import datetime
+import functools
+import threading
+
+try:
+    import asyncio
+except ImportError:  # py2 compat
+    asyncio = None
 
 from six import with_metaclass  # py2 compat
-from peewee import (BaseModel, Model, DateTimeField, ForeignKeyField, IntegerField, BooleanField,
-                    PrimaryKeyField, RelationDescriptor)
+from peewee import (BaseModel, Model, Field, DateTimeField, ForeignKeyField, IntegerField, BooleanField,
+                    PrimaryKeyField, RelationDescriptor, MySQLDatabase, PostgresqlDatabase, fn)
+
+from . import compression
+
+
+class _RecordIdField(Field):
+    '''
+    Holds the primary key of the original record. Unlike ``_original_record`` it is not a foreign key,
+    so it keeps the id after the record is deleted.
+
+    Uses the column type of the primary key, like a ``ForeignKeyField`` does.
+    '''
+
+    def __init__(self, to_field, *args, **kwargs):
+        self.to_field = to_field
+        super(_RecordIdField, self).__init__(*args, **kwargs)
+
+    def get_db_field(self):
+        if isinstance(self.to_field, PrimaryKeyField):
+            return IntegerField.db_field
+        return self.to_field.get_db_field()
+
+    def get_modifiers(self):
+        if isinstance(self.to_field, PrimaryKeyField):
+            return None
+        return self.to_field.get_modifiers()
+
+    def coerce(self, value):
+        return self.to_field.coerce(value)
+
+    def python_value(self, value):
+        return self.to_field.python_value(value)
 
 
 class MetaModel(BaseModel):
@@ -35,11 +73,12 @@ class MetaModel(BaseModel):
 
         # Instantiate the fields we want to add
         # These fields will be added to the nested ``VersionModel``
-        _version_fields = {'_valid_from': DateTimeField(default=datetime.datetime.now),
+        _version_fields = {'_valid_from': DateTimeField(default=datetime.datetime.utcnow),
                            '_valid_until': DateTimeField(null=True, default=None,),
                            '_deleted': BooleanField(default=False),
                            '_original_record': None,  # ForeignKeyField. Added later.
                            '_original_record_id': None,  # added later by peewee
+                           '_record_id': None,  # _RecordIdField. Added later.
                            '_version_id': IntegerField(default=1, index=True),
                            '_id': PrimaryKeyField(primary_key=True)}  # Make an explicit primary key
 
@@ -52,37 +91,98 @@ class MetaModel(BaseModel):
         # Create the top level ``VersionedModel`` class
         new_class = super(MetaModel, self).__new__(self, name, bases, attrs)
 
-        # Mung up the attributes for our ``VersionModel``
-        version_model_attrs = _version_fields.copy()
-        version_model_attrs['__qualname__'] = name + self._version_model_name_suffix
-
-        # Add ForeignKeyField linking to the original record
-        version_model_attrs['_original_record'] = ForeignKeyField(
-            new_class, related_name=self._version_model_related_name, 
-            null=True, on_delete="SET NULL"
-        )
-
-        # Mask all ``peewee.RelationDescriptor`` fields to avoid related name conflicts
-        for field, value in vars(new_class).items():
-            if isinstance(value, RelationDescriptor):
-                version_model_attrs[field] = None
-
-        # needed to avoid infinite recursion
-        version_model_attrs['_RECURSION_BREAK_TEST'] = self._RECURSION_BREAK_TEST
-
-        # Create the nested ``VersionedModel`` class that inherits from the top level new_class
-        VersionModel = type(name + self._version_model_name_suffix,  # Name
-                            (new_class,),  # bases
-                            version_model_attrs)  # attributes
-        # Modify the nested ``VersionedModel``
-        setattr(VersionModel, '_version_fields', _version_fields)
-
-        # Modify the newly created class before returning
-        setattr(new_class, self._version_model_attr_name, VersionModel)
+        # The nested ``VersionModel`` is only built when it is first needed
+        setattr(new_class, self._version_model_attr_name, _LazyVersionModel(_version_fields))
+        setattr(new_class, self._version_model_related_name, _LazyRelatedVersions())
         setattr(new_class, '_version_model_attr_name', self._version_model_attr_name)
 
         return new_class
 
+    def _build_version_model(new_class, _version_fields):
+        '''
+        Creates the nested ``VersionModel`` of ``new_class`` and links them together.
+
+        Called on the first access of ``new_class._VersionModel``.
+
+        :return: the nested ``VersionModel``
+        '''
+        # Use the class attributes of the metaclass
+        self = type(new_class)
+        with _build_lock:
+            # Another thread may have finished building while we waited
+            version_model = vars(new_class)[self._version_model_attr_name]
+            if not isinstance(version_model, _LazyVersionModel):
+                return version_model
+
+            # Mung up the attributes for our ``VersionModel``
+            name = new_class.__name__
+            version_model_attrs = _version_fields.copy()
+            version_model_attrs['__qualname__'] = name + self._version_model_name_suffix
+
+            # Add ForeignKeyField linking to the original record
+            version_model_attrs['_original_record'] = ForeignKeyField(
+                new_class, related_name=self._version_model_related_name,
+                null=True, on_delete="SET NULL"
+            )
+
+            # The id of the original record, kept after it is deleted
+            version_model_attrs['_record_id'] = _RecordIdField(new_class._meta.primary_key, null=True)
+
+            # Mask all ``peewee.RelationDescriptor`` fields to avoid related name conflicts
+            for field, value in vars(new_class).items():
+                if isinstance(value, RelationDescriptor):
+                    version_model_attrs[field] = None
+
+            # needed to avoid infinite recursion
+            version_model_attrs['_RECURSION_BREAK_TEST'] = self._RECURSION_BREAK_TEST
+
+            # Create the nested ``VersionedModel`` class that inherits from the top level new_class
+            VersionModel = type(name + self._version_model_name_suffix,  # Name
+                                (new_class,),  # bases
+                                version_model_attrs)  # attributes
+            # Modify the nested ``VersionedModel``
+            setattr(VersionModel, '_version_fields', _version_fields)
+            # Indexes for keyset pagination of the history
+            VersionModel._meta.indexes = list(VersionModel._meta.indexes) + [
+                (('_original_record', '_version_id'), False),
+                (('_valid_from', '_id'), False),
+                # Lookups of deleted records
+                (('_record_id', '_version_id'), False),
+                (('_deleted', '_valid_until', '_valid_from'), False),
+            ]
+            compression.install(VersionModel)
+
+            # Replace the lazy attribute of the top level class
+            setattr(new_class, self._version_model_attr_name, VersionModel)
+
+            return VersionModel
+
+
+class _LazyVersionModel(object):
+    '''
+    Placeholder for the nested ``VersionModel``. Builds it on first access.
+    '''
+
+    def __init__(self, version_fields):
+        self.version_fields = version_fields
+
+    def __get__(self, instance, owner):
+        return owner._build_version_model(self.version_fields)
+
+
+class _LazyRelatedVersions(object):
+    '''
+    Placeholder for the ``_versions`` back reference. Builds the nested ``VersionModel``,
+    which replaces this placeholder with the real back reference, on first access.
+    '''
+
+    def __get__(self, instance, owner):
+        owner._get_version_model()
+        return getattr(owner if instance is None else instance, owner._version_model_related_name)
+
+
+_build_lock = threading.RLock()
+
 
 # Needed to allow subclassing with differing metaclasses. In this case, BaseModel and Type
 class VersionedModel(with_metaclass(MetaModel, Model)):
@@ -95,7 +195,8 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
 
         :return: bool
         '''
-        return cls._get_version_model() is None
+        # Look at the class itself to not build a lazy ``VersionModel``
+        return vars(cls).get(cls._version_model_attr_name, False) is None
 
     @classmethod
     def _get_version_model(cls):
@@ -114,30 +215,89 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
 
         # wrap everything in a transaction: all or none
         with self._meta.database.atomic():
+            # The previous version ends exactly when the new one starts
+            timestamp = self._get_timestamp()
+
             # Save the parent
             super(VersionedModel, self).save(*args, **kwargs)
 
             # Finalize the previous version
-            self._finalize_current_version()
+            self._finalize_current_version(timestamp)
 
             # Save the new version
-            self._create_new_version()
+            self._create_new_version(timestamp=timestamp)
 
     def delete_instance(self, *args, **kwargs):
         if not self._is_version_model():
             # wrap everything in a transaction: all or none
             with self._meta.database.atomic():
-    
+                # The previous version ends exactly when the deleted one starts
+                timestamp = self._get_timestamp()
+
                 # finalize the previous version
-                self._finalize_current_version()
+                self._finalize_current_version(timestamp)
     
                 # create a new version initialized to current values
-                new_version = self._create_new_version(save=False)
+                new_version = self._create_new_version(save=False, timestamp=timestamp)
                 new_version._deleted = True
                 new_version.save()
             
         # default behaviour
-        return super(VersionedModel, self).delete_instance(*args, **kwargs)
+        result = super(VersionedModel, self).delete_instance(*args, **kwargs)
+
+        # The database may give the id to a new record
+        cache = self._get_version_cache()
+        if cache is not None and not self._is_version_model():
+            cache.invalidate(type(self), self._get_pk_value())
+        return result
+
+    def asave(self, *args, **kwargs):
+        '''
+        Asynchronous counterpart of :meth:`save`.
+
+        :return: :class:`asyncio.Future` resolving to the result of :meth:`save`
+        '''
+        return self._run_in_executor(self.save, *args, **kwargs)
+
+    def adelete_instance(self, *args, **kwargs):
+        '''
+        Asynchronous counterpart of :meth:`delete_instance`.
+
+        :return: :class:`asyncio.Future` resolving to the result of :meth:`delete_instance`
+        '''
+        return self._run_in_executor(self.delete_instance, *args, **kwargs)
+
+    def arevert(self, version):
+        '''
+        Asynchronous counterpart of :meth:`revert`.
+
+        :return: :class:`asyncio.Future` resolving once the new version is saved
+        '''
+        return self._run_in_executor(self.revert, version)
+
+    @classmethod
+    def _run_in_executor(cls, func, *args, **kwargs):
+        '''
+        Runs ``func`` on an executor of the running event loop.
+
+        The whole call, including its transaction, runs on a single worker
+        thread. peewee keeps one connection per thread (``threadlocals=True``,
+        the default), so every worker uses its own connection.
+        The executor can be set with the ``async_executor`` option on the
+        model's ``Meta``. ``None`` uses the loop's default executor.
+
+        :return: :class:`asyncio.Future`
+        :raises RuntimeError: if asyncio is not available or no event loop is running
+        '''
+        if asyncio is None:
+            raise RuntimeError('asyncio is not available')
+        try:
+            loop = asyncio.get_running_loop()
+        except AttributeError:
+            # Python < 3.7
+            loop = asyncio.get_event_loop()
+        executor = getattr(cls._meta, 'async_executor', None)
+        return loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
     @classmethod
     def create_table(cls, *args, **kwargs):
@@ -172,6 +332,223 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
         else:
             return self._version_id
 
+    def get_version(self, version_id):
+        '''
+        Looks up a version of this record.
+
+        If the model's ``Meta`` has a ``version_cache``
+        (:class:`peewee_versioned.VersionCache`) the version is served from it when possible.
+        Only closed versions, which never change, read outside of a transaction are cached.
+
+        :param int version_id: matches ``VersionModel._version_id``
+        :return: the matching ``VersionModel``
+        :raises VersionModel.DoesNotExist: if this record has no such version
+        '''
+        if self._is_version_model():
+            raise RuntimeError('method get_version can not be called on a VersionModel')
+
+        VersionModel = self._get_version_model()
+        cache = self._get_version_cache()
+        key = self._get_version_cache_key(version_id)
+        if cache is not None:
+            data = cache.get(key)
+            if data is not None:
+                version = VersionModel()
+                version._data = data
+                version._prepare_instance()
+                return version
+
+        version = (self._select_history()
+                   .where((VersionModel._original_record == self._get_pk_value()) &
+                          (VersionModel._version_id == version_id))
+                   .get())
+        # A transaction may still be rolled back
+        if (cache is not None and version._valid_until is not None and
+                self._meta.database.transaction_depth() == 0):
+            cache.set(key, version._data)
+        return version
+
+    def get_versions(self, after=None, before=None, limit=20):
+        '''
+        Returns a page of the versions of this record, ordered by ``_version_id``.
+
+        Pages are found with the ``(_original_record_id, _version_id)`` index, so every page
+        costs the same. Pass the ``_version_id`` of the last version of a page as ``after``
+        to get the next page, or of the first one as ``before`` to get the previous page.
+
+        :param int after: only versions with a higher ``_version_id``
+        :param int before: only versions with a lower ``_version_id``
+        :param int limit: maximum number of versions returned
+        :return: list of ``VersionModel``
+        '''
+        if self._is_version_model():
+            raise RuntimeError('method get_versions can not be called on a VersionModel')
+
+        VersionModel = self._get_version_model()
+        query = self._select_history().where(VersionModel._original_record == self._get_pk_value())
+        if after is not None:
+            query = query.where(VersionModel._version_id > after)
+        if before is not None:
+            query = query.where(VersionModel._version_id < before)
+        return self._get_page(query, (VersionModel._version_id,), after is None and before is not None, limit)
+
+    @classmethod
+    def get_history(cls, after=None, before=None, limit=20):
+        '''
+        Returns a page of the versions of all records, ordered by ``(_valid_from, _id)``.
+
+        Pages are found with the ``(_valid_from, _id)`` index, so every page costs the same.
+        Pass ``(version._valid_from, version._id)`` of the last version of a page as ``after``
+        to get the next page, or of the first one as ``before`` to get the previous page.
+
+        :param tuple after: only versions after this ``(_valid_from, _id)``
+        :param tuple before: only versions before this ``(_valid_from, _id)``
+        :param int limit: maximum number of versions returned
+        :return: list of ``VersionModel``
+        '''
+        if cls._is_version_model():
+            raise RuntimeError('method get_history can not be called on a VersionModel')
+
+        VersionModel = cls._get_version_model()
+        query = cls._select_history()
+        if after is not None:
+            valid_from, _id = after
+            # The first conjunct gives the index a start, the second skips the versions already seen
+            query = query.where((VersionModel._valid_from >= valid_from) &
+                                ((VersionModel._valid_from > valid_from) | (VersionModel._id > _id)))
+        if before is not None:
+            valid_from, _id = before
+            query = query.where((VersionModel._valid_from <= valid_from) &
+                                ((VersionModel._valid_from < valid_from) | (VersionModel._id < _id)))
+        return cls._get_page(query, (VersionModel._valid_from, VersionModel._id),
+                             after is None and before is not None, limit)
+
+    @staticmethod
+    def _get_page(query, keys, backwards, limit):
+        '''
+        :return: the first ``limit`` rows of ``query`` in ascending order of ``keys``,
+                 or the last ones if ``backwards``
+        '''
+        if backwards:
+            rows = list(query.order_by(*[key.desc() for key in keys]).limit(limit))
+            rows.reverse()
+            return rows
+        return list(query.order_by(*keys).limit(limit))
+
+    @classmethod
+    def deleted(cls):
+        '''
+        Query of the deleted records: the versions written by :meth:`delete_instance` that are still current
+        and whose id is not in use again. ``_record_id`` holds the id of the deleted record, eg::
+
+            Person.deleted().where(Person._VersionModel._valid_from >= last_week)
+
+        :return: ``SelectQuery`` of ``VersionModel``
+        '''
+        if cls._is_version_model():
+            raise RuntimeError('method deleted can not be called on a VersionModel')
+
+        VersionModel = cls._get_version_model()
+        pk = cls._meta.primary_key
+        live = cls.select(pk).where(pk == VersionModel._record_id)
+        return (cls._select_history()
+                .where((VersionModel._deleted == True) &
+                       VersionModel._valid_until.is_null() &
+                       ~fn.EXISTS(live)))
+
+    @classmethod
+    def undelete(cls, ids, batch_size=500):
+        '''
+        Restores deleted records from their last version, with a new version, ``batch_size`` records
+        at a time. Every batch is a single transaction of a fixed number of queries.
+        The earlier versions are linked to the restored records again.
+
+        Ids that are not in :meth:`deleted` are skipped. Fields that are not versioned, like foreign keys,
+        get their defaults.
+
+        :param ids: primary keys of deleted records
+        :return: number of restored records
+        '''
+        if cls._is_version_model():
+            raise RuntimeError('method undelete can not be called on a VersionModel')
+
+        VersionModel = cls._get_version_model()
+        database = cls._meta.database
+        pk_name = cls._meta.primary_key.name
+        fields = cls._get_fields_to_copy()
+        ids = list(ids)
+        restored = 0
+
+        for start in range(0, len(ids), batch_size):
+            with database.atomic():
+                tombstones = list(cls.deleted().where(VersionModel._record_id << ids[start:start + batch_size]))
+                if not tombstones:
+                    continue
+                timestamp = cls._get_timestamp()
+
+                records = []
+                versions = []
+                for tombstone in tombstones:
+                    record = dict((field, getattr(tombstone, field)) for field in fields)
+                    record[pk_name] = tombstone._record_id
+                    records.append(record)
+
+                    # Compressed values are copied as they are
+                    version = dict((field, tombstone._data.get(field)) for field in fields)
+                    version.update(_original_record=tombstone._record_id,
+                                   _record_id=tombstone._record_id,
+                                   _version_id=tombstone._version_id + 1,
+                                   _valid_from=timestamp,
+                                   _deleted=False)
+                    versions.append(version)
+
+                (VersionModel
+                 .update(_valid_until=timestamp)
+                 .where(VersionModel._id << [tombstone._id for tombstone in tombstones])
+                 .execute())
+                cls.insert_many(records).execute()
+                # Link the earlier versions, their ``_original_record_id`` was set to NULL on delete
+                (VersionModel
+                 .update(_original_record=VersionModel._record_id)
+                 .where(VersionModel._record_id << [tombstone._record_id for tombstone in tombstones])
+                 .execute())
+                VersionModel.insert_many(versions).execute()
+                restored += len(tombstones)
+        return restored
+
+    @classmethod
+    def _get_history_database(cls):
+        '''
+        :return: the database history reads go to: the ``history_database`` configured on
+                 ``Meta``, or the model's own database if there is none or a transaction is
+                 open on it, so a transaction always reads its own writes
+        '''
+        database = cls._meta.database
+        history_database = getattr(cls._meta, 'history_database', None)
+        if history_database is None or database.transaction_depth() > 0:
+            return database
+        return history_database
+
+    @classmethod
+    def _select_history(cls):
+        '''
+        :return: ``VersionModel.select()`` bound to :meth:`_get_history_database`
+        '''
+        query = cls._get_version_model().select()
+        # clones of the query keep its database
+        query.database = cls._get_history_database()
+        return query
+
+    @classmethod
+    def _get_version_cache(cls):
+        '''
+        :return: the ``version_cache`` configured on ``Meta`` or ``None``
+        '''
+        return getattr(cls._meta, 'version_cache', None)
+
+    def _get_version_cache_key(self, version_id):
+        return (type(self), self._get_pk_value(), version_id)
+
     def revert(self, version):
         '''
         Changes all attributes to match what was saved in ``version``
@@ -189,21 +566,21 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
             raise RuntimeError('method revert can not be called on a VersionModel')
 
         VersionModel = self._get_version_model()
-        if isinstance(version, VersionModel):
-            version_model = version
-        elif version >= 0:
-            version_model = self._versions.filter(VersionModel._version_id == version).get()
-        else:  # version < 0
-            version_model = (self._versions
-                             .order_by(VersionModel._version_id.desc())
-                             .offset(-version)
-                             .limit(1))[0]
+        # Versions are looked up on the model's own database, not on a ``history_database`` lagging behind
+        with self._meta.database.atomic():
+            if isinstance(version, VersionModel):
+                version_model = version
+            elif version >= 0:
+                version_model = self.get_version(version)
+            else:  # version < 0
+                # ``_version_id``'s are consecutive, a direct lookup avoids scanning with an offset
+                version_model = self.get_version(self.version_id + version)
 
-        fields_to_copy = self._get_fields_to_copy()
-        for field in fields_to_copy:
-            setattr(self, field, getattr(version_model, field))
+            fields_to_copy = self._get_fields_to_copy()
+            for field in fields_to_copy:
+                setattr(self, field, getattr(version_model, field))
 
-        self.save()
+            self.save()
 
     @classmethod
     def _get_fields_to_copy(cls):
@@ -215,12 +592,13 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
                 fields.append(key)
         return fields
 
-    def _create_new_version(self, save=True):
+    def _create_new_version(self, save=True, timestamp=None):
         '''
         Creates a new row of ``VersionModel`` and initializes
         it's fields to match the parent.
 
         :param bool save: should the new_version be saved before returning?
+        :param timestamp: ``_valid_from`` of the new version, defaults to :meth:`_get_timestamp`
         :return: the newly created instance of ``VersionModel``
         '''
 
@@ -241,19 +619,66 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
         for field in fields_to_copy:
             setattr(new_version, field, getattr(self, field))
         new_version._original_record = self
+        new_version._record_id = self._get_pk_value()
         new_version._version_id = new_version_id
+        new_version._valid_from = timestamp or self._get_timestamp()
+        compression.compress_version(new_version)
         if save is True:
             new_version.save()
         return new_version
 
+    @classmethod
+    def _get_timestamp(cls):
+        '''
+        Reads the clock once for a versioned write. The timestamp is in UTC.
+
+        With the ``database_clock`` option of the model's ``Meta`` set to ``True``
+        the database's clock is used instead of python's.
+
+        :return: :class:`datetime.datetime`
+        '''
+        if not getattr(cls._meta, 'database_clock', False):
+            return datetime.datetime.utcnow()
+
+        database = cls._meta.database
+        if isinstance(database, PostgresqlDatabase):
+            sql = "SELECT now() AT TIME ZONE 'UTC'"
+        elif isinstance(database, MySQLDatabase):
+            sql = 'SELECT UTC_TIMESTAMP(6)'
+        else:
+            sql = "SELECT strftime('%Y-%m-%d %H:%M:%f', 'now')"
+        value = database.execute_sql(sql).fetchone()[0]
+        # SQLite returns a string
+        return cls._get_version_model()._valid_from.python_value(value)
+
+    def get_version_at(self, timestamp):
+        '''
+        Looks up the version of this record that was current at ``timestamp`` (UTC).
+
+        A version is current from its ``_valid_from`` up to, but not including, its ``_valid_until``.
+
+        :return: the matching ``VersionModel`` or ``None``
+        '''
+        if self._is_version_model():
+            raise RuntimeError('method get_version_at can not be called on a VersionModel')
+
+        VersionModel = self._get_version_model()
+        return (self._select_history()
+                .where((VersionModel._original_record == self._get_pk_value()) &
+                       (VersionModel._valid_from <= timestamp) &
+                       (VersionModel._valid_until.is_null() | (VersionModel._valid_until > timestamp)))
+                .order_by(VersionModel._valid_from.desc())
+                .first())
+
     def _get_current_version(self):
         '''
         :return: current version or ``None`` if not found
         '''
         VersionModel = self._get_version_model()
         try:
-            current_version = (self._versions.select()
-                               .where(VersionModel._valid_until.is_null())
+            current_version = (self._select_history()
+                               .where((VersionModel._original_record == self._get_pk_value()) &
+                                      VersionModel._valid_until.is_null())
                                )  # null record
             assert(len(current_version) == 1)
             return current_version[0]
@@ -267,8 +692,11 @@ class VersionedModel(with_metaclass(MetaModel, Model)):
                                    'More than one current version was found for {}'
                                    .format(self.__class__))
 
-    def _finalize_current_version(self):
+    def _finalize_current_version(self, timestamp=None):
+        '''
+        Ends the current version at ``timestamp``, defaults to :meth:`_get_timestamp`
+        '''
         current_version = self._get_current_version()
         if current_version is not None:
-            current_version._valid_until = datetime.datetime.utcnow()
+            current_version._valid_until = timestamp or self._get_timestamp()
             current_version.save()
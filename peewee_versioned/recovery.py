@@ -0,0 +1,194 @@
+'''
+Rebuilds the live table of a ``VersionedModel`` from its history.
+
+Rows removed without going through ``delete_instance()``, for example by a
+class level ``.delete()`` or a truncated table, still have their versions.
+:func:`rebuild` inserts them back::
+
+    rebuild(Person)                                      # current versions
+    rebuild(Person, start_id=1000, end_id=2000)          # a range of ids
+    rebuild(Person, as_of=datetime.datetime(2016, 4, 24))  # as they were
+
+Only the versioned fields are restored, relations (``ForeignKeyField``'s)
+are not part of the history.
+'''
+from peewee import PostgresqlDatabase, fn
+
+from . import compression
+from .snapshot import valid_at
+
+
+def _get_field_pairs(model):
+    '''
+    :return: list of (live field, version field) tuples to copy, the primary key first
+    '''
+    VersionModel = model._get_version_model()
+    pk = model._meta.primary_key
+    pairs = [(pk, VersionModel._record_id)]
+    for field in model._meta.sorted_fields:
+        if field is not pk and field.name in VersionModel._meta.fields:
+            pairs.append((field, VersionModel._meta.fields[field.name]))
+    return pairs
+
+
+def rebuild(model, as_of=None, start_id=None, end_id=None, batch_size=10000):
+    '''
+    Inserts the records missing from the table of ``model`` using their versions.
+
+    Records are processed in ranges of ``batch_size`` ids, each in its own transaction,
+    so memory use is bounded and an interrupted rebuild can simply be run again.
+    Records whose version is a deletion (``_deleted``) are skipped, rows still present are left alone.
+
+    The versions of the restored records are linked to them again. Compressed fields are written
+    decompressed to the table, new versions keep the stored, compressed values.
+
+    When ``as_of`` is given, records are restored as they were at that moment. If that is not their
+    current version, a new version is created for them, just like ``revert()`` does.
+
+    Records are found by the ``_record_id`` of their versions, versions written before that column existed
+    need it filled in, see the README.
+
+    :param model: the ``VersionedModel`` subclass to restore
+    :param as_of: restore the versions current at this timestamp, ``None`` for the current versions
+    :param start_id: first record id to restore, inclusive
+    :param end_id: last record id to restore, exclusive
+    :param int batch_size: number of record ids per transaction, ids must be integers
+    :return: number of restored records
+    '''
+    VersionModel = model._get_version_model()
+    database = model._meta.database
+    pk = model._meta.primary_key
+    record_id = VersionModel._record_id
+
+    # The range of ids to visit
+    bounds = VersionModel.select(fn.MIN(record_id), fn.MAX(record_id))
+    if start_id is not None:
+        bounds = bounds.where(record_id >= start_id)
+    if end_id is not None:
+        bounds = bounds.where(record_id < end_id)
+    low, high = bounds.tuples().get()
+    if low is None:
+        return 0
+
+    if as_of is None:
+        valid = VersionModel._valid_until.is_null()
+    else:
+        valid = valid_at(VersionModel, as_of)
+
+    # Rows go through python to be decompressed or to create new versions,
+    # otherwise a single ``INSERT ... SELECT`` per batch does the work
+    stream = bool(compression.get_compressed_fields(VersionModel)) or as_of is not None
+
+    restored = 0
+    for chunk_start in range(low, high + 1, batch_size):
+        chunk_end = min(chunk_start + batch_size, high + 1)
+        existing = model.select(pk).where((pk >= chunk_start) & (pk < chunk_end))
+        missing = ((record_id >= chunk_start) &
+                   (record_id < chunk_end) &
+                   valid &
+                   (VersionModel._deleted == False) &
+                   ~(record_id << existing))
+        with database.atomic():
+            if stream:
+                restored += _restore_versions(model, list(VersionModel.select().where(missing)), as_of)
+            else:
+                pairs = _get_field_pairs(model)
+                query = (VersionModel
+                         .select(*[version_field for field, version_field in pairs])
+                         .where(missing))
+                before = existing.count()
+                model.insert_from([field for field, version_field in pairs], query).execute()
+                restored += existing.count() - before
+
+            # Deleting the rows set ``_original_record_id`` to NULL on databases enforcing foreign keys
+            (VersionModel
+             .update(_original_record=record_id)
+             .where((record_id >= chunk_start) &
+                    (record_id < chunk_end) &
+                    VersionModel._original_record.is_null() &
+                    (record_id << existing))
+             .execute())
+
+    reset_sequence(model)
+    return restored
+
+
+def _restore_versions(model, versions, as_of):
+    '''
+    Inserts ``versions`` in the table of ``model`` and creates new versions for the
+    records that are not restored to their current version.
+
+    :return: number of restored records
+    '''
+    if not versions:
+        return 0
+    pairs = _get_field_pairs(model)
+    rows = []
+    for version in versions:
+        row = {}
+        for field, version_field in pairs:
+            if version_field.name == '_record_id':
+                row[field] = version._record_id
+            else:
+                row[field] = getattr(version, version_field.name)
+        rows.append(row)
+    model.insert_many(rows).execute()
+
+    if as_of is not None:
+        _append_versions(model, [version for version in versions if version._valid_until is not None])
+    return len(rows)
+
+
+def _append_versions(model, versions):
+    '''
+    Makes copies of ``versions`` the current versions of their records
+    '''
+    if not versions:
+        return
+    VersionModel = model._get_version_model()
+    record_id = VersionModel._record_id
+    ids = [version._record_id for version in versions]
+
+    last_version_ids = dict(VersionModel
+                            .select(record_id, fn.MAX(VersionModel._version_id))
+                            .where(record_id << ids)
+                            .group_by(record_id)
+                            .tuples())
+
+    now = model._get_timestamp()
+    (VersionModel
+     .update(_valid_until=now)
+     .where((record_id << ids) & VersionModel._valid_until.is_null())
+     .execute())
+
+    rows = []
+    for version in versions:
+        row = dict((name, value) for name, value in version._data.items()
+                   if name not in ('_id', '_valid_from', '_valid_until', '_deleted', '_version_id'))
+        row['_original_record'] = version._record_id
+        row['_version_id'] = last_version_ids[version._record_id] + 1
+        row['_valid_from'] = now
+        rows.append(row)
+    VersionModel.insert_many(rows).execute()
+
+
+def reset_sequence(model):
+    '''
+    Moves the primary key sequence of ``model`` past the highest id in the table.
+
+    Only needed on PostgreSQL, SQLite and MySQL derive the next id from the table's content.
+    '''
+    database = model._meta.database
+    pk = model._meta.primary_key
+    if not isinstance(database, PostgresqlDatabase) or not model._meta.auto_increment:
+        return
+    table = model._meta.db_table
+    if model._meta.schema:
+        table = '{}.{}'.format(model._meta.schema, table)
+    if pk.sequence:
+        sequence = "'{}'".format(pk.sequence)
+    else:
+        sequence = "pg_get_serial_sequence('{}', '{}')".format(table, pk.db_column)
+    database.execute_sql(
+        'SELECT setval({sequence}, COALESCE((SELECT MAX("{column}") FROM {table}), 0) + 1, false)'
+        .format(sequence=sequence, column=pk.db_column, table=table))
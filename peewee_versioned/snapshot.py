@@ -0,0 +1,177 @@
+'''
+Point-in-time snapshot tables of ``VersionedModel``'s.
+
+A :class:`Snapshot` materializes the state of a versioned model at a given
+moment in a regular table. Refreshing it to another moment only applies the
+version rows that started or ended in between::
+
+    daily = Snapshot(Person, name='person_daily')
+    daily.refresh(datetime.datetime(2016, 4, 24))
+    daily.model.select().where(daily.model.is_relative == True)
+    daily.refresh(datetime.datetime(2016, 4, 25))  # incremental
+'''
+from copy import deepcopy
+
+from peewee import CharField, DateTimeField, IntegerField, Model, PrimaryKeyField
+
+from . import compression
+
+_state_models = {}
+
+
+def get_state_model(database):
+    '''
+    :return: the model storing the refresh state of the snapshots in ``database``
+    '''
+    key = id(database)
+    if key not in _state_models:
+        class SnapshotState(Model):
+            name = CharField(unique=True)
+            as_of = DateTimeField()
+
+            class Meta:
+                db_table = 'snapshotstate'
+
+        SnapshotState._meta.database = database
+        _state_models[key] = SnapshotState
+    return _state_models[key]
+
+
+def _copy_field(field):
+    '''
+    :return: a copy of ``field`` suitable for a snapshot table, without constraints or sequences
+    '''
+    if isinstance(field, PrimaryKeyField):
+        return IntegerField(null=True, db_column=field.db_column)
+    copy = deepcopy(field)
+    copy.primary_key = False
+    copy.unique = False
+    copy.index = False
+    copy.null = True
+    copy.sequence = None
+    return copy
+
+
+def valid_at(VersionModel, timestamp):
+    '''
+    :return: where clause selecting the versions that were current at ``timestamp``
+    '''
+    return ((VersionModel._valid_from <= timestamp) &
+            (VersionModel._valid_until.is_null() | (VersionModel._valid_until > timestamp)))
+
+
+class Snapshot(object):
+    '''
+    A table holding the state of ``model`` at a point in time.
+
+    :param model: the ``VersionedModel`` subclass
+    :param str name: table name of the snapshot, defaults to the model's table name + ``snapshot``
+    '''
+
+    def __init__(self, model, name=None):
+        self.source = model
+        self.name = name or model._meta.db_table + 'snapshot'
+        self.database = model._meta.database
+        self.State = get_state_model(self.database)
+        self.model = self._create_model()
+
+    def _create_model(self):
+        source = self.source
+        version_fields = source._get_version_model()._meta.fields
+        pk = source._meta.primary_key
+        attrs = {}
+        for field in source._meta.sorted_fields:
+            # Only the fields that are versioned
+            if field is pk or field.name in version_fields:
+                attrs[field.name] = _copy_field(field)
+        # The record id identifies rows of the snapshot
+        attrs[pk.name].primary_key = True
+        attrs[pk.name].null = False
+        attrs['_version_id'] = IntegerField()
+
+        class Meta:
+            pass
+        Meta.database = self.database
+        Meta.db_table = self.name
+        Meta.compressed_fields = compression.get_compressed_fields(source)
+        attrs['Meta'] = Meta
+
+        model = type(str(self.name), (Model,), attrs)
+        # The snapshot holds values as they are stored in the version table
+        compression.install(model)
+        return model
+
+    @property
+    def as_of(self):
+        '''
+        :return: the timestamp of the last refresh or ``None``
+        '''
+        state = self.State.select().where(self.State.name == self.name).first()
+        return state.as_of if state is not None else None
+
+    def refresh(self, timestamp):
+        '''
+        Brings the snapshot to the state at ``timestamp``.
+
+        The first refresh copies all versions current at ``timestamp``. Later refreshes only replace the
+        records having a version starting or ending between the previous timestamp and ``timestamp``.
+        Refreshing backwards in time works the same way.
+        '''
+        VersionModel = self.source._get_version_model()
+        Snapshot = self.model
+        record_id = VersionModel._record_id
+
+        self.State.create_table(fail_silently=True)
+        Snapshot.create_table(fail_silently=True)
+
+        # Columns to copy, in the same order for both tables
+        snapshot_fields = [field for field in Snapshot._meta.sorted_fields]
+        version_fields = []
+        for field in snapshot_fields:
+            if field is Snapshot._meta.primary_key:
+                version_fields.append(record_id)
+            else:
+                version_fields.append(VersionModel._meta.fields[field.name])
+
+        previous = self.as_of
+        with self.database.atomic():
+            current = (VersionModel
+                       .select(*version_fields)
+                       .where(valid_at(VersionModel, timestamp) &
+                              (VersionModel._deleted == False)))
+
+            if previous is None:
+                Snapshot.delete().execute()
+            else:
+                start, end = sorted((previous, timestamp))
+                # One range search per index instead of an OR no index can serve.
+                # Listing both values of ``_deleted`` lets the ``(_deleted, _valid_until, ...)`` index
+                # search the ``_valid_until`` range
+                started = (VersionModel
+                           .select(record_id)
+                           .where((VersionModel._valid_from > start) & (VersionModel._valid_from <= end)))
+                ended = (VersionModel
+                         .select(record_id)
+                         .where((VersionModel._deleted << [False, True]) &
+                                (VersionModel._valid_until > start) &
+                                (VersionModel._valid_until <= end)))
+                changed = started | ended
+                Snapshot.delete().where(Snapshot._meta.primary_key << changed).execute()
+                current = current.where(record_id << changed)
+
+            Snapshot.insert_from(snapshot_fields, current).execute()
+
+            updated = (self.State
+                       .update(as_of=timestamp)
+                       .where(self.State.name == self.name)
+                       .execute())
+            if not updated:
+                self.State.create(name=self.name, as_of=timestamp)
+
+    def drop(self):
+        '''
+        Drops the snapshot table and forgets its state
+        '''
+        self.model.drop_table(fail_silently=True)
+        if self.State.table_exists():
+            self.State.delete().where(self.State.name == self.name).execute()
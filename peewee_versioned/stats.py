@@ -0,0 +1,207 @@
+'''
+Statistics about the size and growth of the ``VersionModel`` tables.
+
+Everything is computed with aggregate queries. For very large tables,
+``sample`` restricts the queries to ranges of record ids covering a fraction
+of the records and scales the totals accordingly.
+
+From the command line, import the modules defining the models and report on
+every ``VersionedModel`` found::
+
+    python -m peewee_versioned.stats myapp.models --top 5 --sample 0.1
+'''
+import argparse
+import datetime
+import importlib
+import json
+import math
+
+from peewee import MySQLDatabase, OperationalError, PostgresqlDatabase, SQL, SqliteDatabase, fn
+
+from .peewee_versioned import VersionedModel
+
+PERCENTILES = (50, 90, 99)
+# Number of id ranges a sample is spread over
+SAMPLE_RANGES = 100
+
+
+def get_versioned_models(base=VersionedModel):
+    '''
+    :return: list of all ``VersionedModel`` subclasses defined so far, without the nested ``VersionModel``'s
+    '''
+    models = []
+    for subclass in base.__subclasses__():
+        if subclass._is_version_model():
+            continue
+        models.append(subclass)
+        models.extend(get_versioned_models(subclass))
+    return models
+
+
+def _percentiles(histogram):
+    '''
+    :param histogram: list of (versions per record, number of records) tuples
+    :return: dict of ``'p50'``, ``'p90'``... -> versions per record
+    '''
+    histogram = sorted(histogram)
+    total = sum(records for versions, records in histogram)
+    result = {}
+    for percentile in PERCENTILES:
+        seen = 0
+        for versions, records in histogram:
+            seen += records
+            if seen * 100 >= percentile * total:
+                result['p{}'.format(percentile)] = versions
+                break
+    return result
+
+
+def get_table_bytes(model):
+    '''
+    :return: bytes used by the table of ``model``, indexes included, or ``None`` if the backend doesn't tell
+    '''
+    database = model._meta.database
+    table = model._meta.db_table
+    try:
+        if isinstance(database, PostgresqlDatabase):
+            cursor = database.execute_sql('SELECT pg_total_relation_size(%s)', (table,))
+        elif isinstance(database, MySQLDatabase):
+            cursor = database.execute_sql(
+                'SELECT data_length + index_length FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s', (table,))
+        elif isinstance(database, SqliteDatabase):
+            # Needs SQLite compiled with SQLITE_ENABLE_DBSTAT_VTAB
+            cursor = database.execute_sql(
+                'SELECT SUM(pgsize) FROM dbstat WHERE name = ? OR name IN '
+                '(SELECT name FROM sqlite_master WHERE type = ? AND tbl_name = ?)',
+                (table, 'index', table))
+        else:
+            return None
+    except OperationalError:
+        return None
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _sample_ranges(low, high, sample):
+    '''
+    :return: list of ``[start, end)`` id ranges spread evenly over ``[low, high]``, covering about ``sample`` of it
+    '''
+    width = high - low + 1
+    step = max(int(math.ceil(float(width) / SAMPLE_RANGES)), int(math.ceil(1 / sample)))
+    size = max(int(step * sample), 1)
+    return [(start, min(start + size, high + 1)) for start in range(low, high + 1, step)]
+
+
+def history_stats(model, top=10, sample=None, days=30):
+    '''
+    Collects statistics about the history of ``model``.
+
+    :param model: a ``VersionedModel`` subclass
+    :param int top: number of records with the most versions to report
+    :param float sample: fraction of the records to look at, between 0 and 1. ``None`` looks at all of them.
+                         The records are taken from ranges of ids found with the ``_record_id`` index,
+                         ids must be integers. Counts are scaled up, ``hottest`` only holds sampled records.
+    :param int days: number of days of growth to report
+    :return: dict with
+
+      * ``version_rows``: number of version rows
+      * ``records``: number of records with at least one version
+      * ``versions_per_record``: dict with the ``mean``, ``max`` and percentiles ``p50``, ``p90`` and ``p99``
+      * ``hottest``: list of (record id, versions) of the records with most versions
+      * ``bytes``: size of the version table or ``None``
+      * ``bytes_per_version``: ``bytes`` / ``version_rows`` or ``None``
+      * ``growth_per_day``: list of (date, new versions) for the last ``days`` days
+    '''
+    VersionModel = model._get_version_model()
+    record_id = VersionModel._record_id
+
+    scale = 1
+    # Versions written before ``_record_id`` existed don't belong to a known record
+    where = record_id.is_null(False)
+    if sample is not None:
+        if not 0 < sample <= 1:
+            raise ValueError('sample must be between 0 and 1')
+        low, high = VersionModel.select(fn.MIN(record_id), fn.MAX(record_id)).tuples().get()
+        if low is not None:
+            ranges = _sample_ranges(low, high, sample)
+            covered = sum(end - start for start, end in ranges)
+            if covered < high - low + 1:
+                scale = float(high - low + 1) / covered
+                in_ranges = None
+                for start, end in ranges:
+                    clause = (record_id >= start) & (record_id < end)
+                    in_ranges = clause if in_ranges is None else in_ranges | clause
+                where &= in_ranges
+
+    def select(*selection):
+        return VersionModel.select(*selection).where(where)
+
+    # Number of records per number of versions
+    per_record = select(fn.COUNT(VersionModel._id).alias('versions')).group_by(record_id).alias('per_record')
+    histogram = list(VersionModel
+                     .select(SQL('versions'), fn.COUNT(SQL('*')))
+                     .from_(per_record)
+                     .group_by(SQL('versions'))
+                     .tuples())
+    version_rows = sum(versions * records for versions, records in histogram)
+    records = sum(records for versions, records in histogram)
+
+    versions_per_record = _percentiles(histogram)
+    versions_per_record['max'] = max(versions for versions, records in histogram) if histogram else None
+    versions_per_record['mean'] = float(version_rows) / records if records else None
+
+    hottest = list(select(record_id, fn.COUNT(VersionModel._id).alias('versions'))
+                   .group_by(record_id)
+                   .order_by(SQL('versions').desc(), record_id)
+                   .limit(top)
+                   .tuples())
+
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days)
+    day = fn.DATE(VersionModel._valid_from).coerce(False)
+    growth_per_day = [(str(date), int(round(count * scale))) for date, count in
+                      select(day, fn.COUNT(VersionModel._id))
+                      .where(VersionModel._valid_from >= since)
+                      .group_by(day)
+                      .order_by(day)
+                      .tuples()]
+
+    table_bytes = get_table_bytes(VersionModel)
+    total_rows = int(round(version_rows * scale))
+    return {
+        'version_rows': total_rows,
+        'records': int(round(records * scale)),
+        'versions_per_record': versions_per_record,
+        'hottest': hottest,
+        'bytes': table_bytes,
+        'bytes_per_version': float(table_bytes) / total_rows if table_bytes and total_rows else None,
+        'growth_per_day': growth_per_day,
+    }
+
+
+def all_history_stats(base=VersionedModel, **kwargs):
+    '''
+    :param base: report on the subclasses of ``base`` having a version table
+    :param kwargs: passed on to :func:`history_stats`
+    :return: dict of model name -> statistics
+    '''
+    models = [model for model in get_versioned_models(base) if model._get_version_model().table_exists()]
+    return dict((model.__name__, history_stats(model, **kwargs)) for model in models)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='History statistics of all VersionedModels')
+    parser.add_argument('modules', nargs='+', help='modules defining the models')
+    parser.add_argument('--top', type=int, default=10, help='number of hottest records to show')
+    parser.add_argument('--sample', type=float, default=None, help='fraction of the records to look at')
+    parser.add_argument('--days', type=int, default=30, help='number of days of growth to show')
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        importlib.import_module(module)
+    stats = all_history_stats(top=args.top, sample=args.sample, days=args.days)
+    print(json.dumps(stats, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
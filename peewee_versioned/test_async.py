@@ -0,0 +1,127 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from peewee import CharField, SqliteDatabase
+
+from . import VersionedModel
+
+# Every worker thread opens its own connection, so the database must be a file
+database = SqliteDatabase(None)
+
+
+class Person(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = database
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        database.init(os.path.join(self.directory, 'async.db'))
+        Person.create_table()
+        self.people = [Person.create(name=str(i)) for i in range(10)]
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        Person.drop_table()
+        database.close()
+        shutil.rmtree(self.directory)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def count_ticks_while(self, work):
+        '''
+        Runs the coroutine function ``work`` next to a coroutine counting event loop iterations.
+
+        :return: number of iterations the event loop managed while ``work`` ran
+        '''
+        state = {'done': False, 'ticks': 0}
+
+        async def ticker():
+            while not state['done']:
+                state['ticks'] += 1
+                await asyncio.sleep(0)
+
+        async def runner():
+            await work()
+            state['done'] = True
+
+        async def main():
+            await asyncio.gather(ticker(), runner())
+
+        self.run_async(main())
+        return state['ticks']
+
+    def test_asave_should_create_new_version(self):
+        person = self.people[0]
+        person.name = 'async'
+
+        async def work():
+            await person.asave()
+        self.run_async(work())
+
+        self.assertEqual(person.version_id, 2)
+        self.assertEqual(person._get_current_version().name, 'async')
+
+    def test_adelete_instance_should_create_deleted_version(self):
+        person = self.people[0]
+
+        async def work():
+            await person.adelete_instance()
+        self.run_async(work())
+
+        self.assertRaises(Person.DoesNotExist, Person.get, id=person.id)
+        deleted = Person._VersionModel.get(Person._VersionModel._deleted == True)
+        self.assertIsNone(deleted._valid_until)
+
+    def test_arevert(self):
+        person = self.people[0]
+        person.name = 'changed'
+        person.save()
+
+        async def work():
+            await person.arevert(1)
+        self.run_async(work())
+
+        self.assertEqual(person.name, '0')
+        self.assertEqual(person.version_id, 3)
+
+    def test_concurrent_asave_should_version_every_record(self):
+        for person in self.people:
+            person.name += '_async'
+
+        async def work():
+            await asyncio.gather(*[person.asave() for person in self.people])
+        self.run_async(work())
+
+        for person in self.people:
+            self.assertEqual(person.version_id, 2)
+            self.assertEqual(person._get_current_version().name, person.name)
+
+    def test_async_should_not_block_event_loop(self):
+        async def blocking():
+            for person in self.people:
+                person.name += '_blocking'
+                person.save()
+
+        async def concurrent():
+            for person in self.people:
+                person.name += '_async'
+            await asyncio.gather(*[person.asave() for person in self.people])
+
+        # The blocking calls starve every other coroutine,
+        # the ticker only runs once before and once after them
+        self.assertLessEqual(self.count_ticks_while(blocking), 2)
+        self.assertGreater(self.count_ticks_while(concurrent), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from peewee import CharField, Model, SqliteDatabase, TextField
+
+from . import VersionedModel
+from . import backfill as backfill_module
+from .backfill import backfill, backfill_chunk
+from .compression import MARKER
+
+database = SqliteDatabase(':memory:')
+# Worker processes need a database they can open themselves
+file_database = SqliteDatabase(None)
+
+
+class LegacyPerson(Model):
+    name = CharField()
+
+    class Meta:
+        database = database
+        db_table = 'person'
+
+
+class Person(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = database
+        db_table = 'person'
+
+
+class Note(VersionedModel):
+    body = TextField()
+
+    class Meta:
+        database = database
+        compressed_fields = {'body': 100}
+
+
+class FilePerson(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = file_database
+        db_table = 'person'
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        # A populated table from before the model was versioned
+        LegacyPerson.create_table()
+        LegacyPerson.insert_many([{'name': str(i)} for i in range(25)]).execute()
+
+    def tearDown(self):
+        Person.drop_table()
+
+    def test_should_create_first_versions(self):
+        progress = []
+        self.assertEqual(backfill(Person, chunk_size=10,
+                                  progress=lambda *args: progress.append(args)), 25)
+        self.assertEqual(progress, [(1, 11, 10), (11, 21, 10), (21, 26, 5)])
+
+        person = Person.get(Person.name == '3')
+        self.assertEqual(person.version_id, 1)
+        version = person._get_current_version()
+        self.assertEqual(version.name, '3')
+        self.assertFalse(version._deleted)
+
+        # Versioning works as usual afterwards
+        person.name = 'changed'
+        person.save()
+        self.assertEqual(person.version_id, 2)
+        self.assertEqual(person.get_version(1).name, '3')
+
+    def test_should_resume(self):
+        # An interrupted backfill
+        Person._VersionModel.create_table()
+        self.assertEqual(backfill_chunk(Person, 1, 8), 7)
+        Person.create(name='new')
+
+        self.assertEqual(backfill(Person, chunk_size=10), 18)
+        self.assertEqual(backfill(Person), 0)
+        self.assertEqual(Person._VersionModel.select().count(), 26)
+
+    def test_should_start_at_id(self):
+        self.assertEqual(backfill(Person, start_id=21), 5)
+
+    def test_should_run_chunks_in_process_on_sqlite(self):
+        self.assertEqual(backfill(Person, chunk_size=5, workers=4), 25)
+
+
+
+class TestCompressedBackfill(unittest.TestCase):
+
+    def setUp(self):
+        Note.create_table()
+
+    def tearDown(self):
+        Note.drop_table()
+
+    def test_should_compress_fields(self):
+        Note.insert_many([{'body': 'x' * 1000}, {'body': 'short'}]).execute()
+        self.assertEqual(backfill(Note), 2)
+
+        stored = [version._data['body'] for version in Note._VersionModel.select().order_by(Note._VersionModel._id)]
+        self.assertTrue(stored[0].startswith(MARKER))
+        self.assertEqual(stored[1], 'short')
+        self.assertEqual(Note.get(Note.body == 'short').get_version(1).body, 'short')
+        self.assertEqual(Note.get(Note.body == 'x' * 1000).get_version(1).body, 'x' * 1000)
+
+
+class TestParallelBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        file_database.init(os.path.join(self.directory, 'backfill.db'))
+        FilePerson.create_table()
+        FilePerson.insert_many([{'name': str(i)} for i in range(25)]).execute()
+        self.supports_parallel_writes = backfill_module.supports_parallel_writes
+        # Only one writer at a time, but the workers wait for each other
+        backfill_module.supports_parallel_writes = lambda database: True
+
+    def tearDown(self):
+        backfill_module.supports_parallel_writes = self.supports_parallel_writes
+        if not file_database.is_closed():
+            file_database.close()
+        shutil.rmtree(self.directory)
+
+    def test_should_run_chunks_in_workers(self):
+        progress = []
+        self.assertEqual(backfill(FilePerson, chunk_size=5, workers=2,
+                                  progress=lambda *args: progress.append(args)), 25)
+        self.assertEqual([chunk_start for chunk_start, chunk_end, count in progress], [1, 6, 11, 16, 21])
+        self.assertEqual(FilePerson._VersionModel.select().count(), 25)
+        self.assertEqual(FilePerson.get(FilePerson.name == '7').version_id, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
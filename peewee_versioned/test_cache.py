@@ -0,0 +1,145 @@
+import unittest
+
+from peewee import CharField, SqliteDatabase
+
+from . import VersionedModel, VersionCache
+
+database = SqliteDatabase(':memory:')
+cache = VersionCache(maxsize=3)
+
+
+class Person(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = database
+        version_cache = cache
+
+
+class FakeTimer(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestVersionCache(unittest.TestCase):
+
+    def test_should_count_hits_and_misses(self):
+        version_cache = VersionCache()
+        self.assertIsNone(version_cache.get('a'))
+        version_cache.set('a', {'name': 'a'})
+        self.assertEqual(version_cache.get('a'), {'name': 'a'})
+        self.assertEqual(version_cache.stats, {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_should_evict_least_recently_used(self):
+        version_cache = VersionCache(maxsize=2)
+        version_cache.set('a', {})
+        version_cache.set('b', {})
+        version_cache.get('a')
+        version_cache.set('c', {})
+        self.assertIsNone(version_cache.get('b'))
+        self.assertIsNotNone(version_cache.get('a'))
+        self.assertIsNotNone(version_cache.get('c'))
+
+    def test_should_expire_after_ttl(self):
+        timer = FakeTimer()
+        version_cache = VersionCache(ttl=10, timer=timer)
+        version_cache.set('a', {})
+        timer.now = 9
+        self.assertIsNotNone(version_cache.get('a'))
+        timer.now = 10
+        self.assertIsNone(version_cache.get('a'))
+        self.assertEqual(len(version_cache), 0)
+
+    def test_should_invalidate_versions_of_record(self):
+        version_cache = VersionCache(maxsize=3)
+        version_cache.set((Person, 1, 1), {})
+        version_cache.set((Person, 1, 2), {})
+        version_cache.set((Person, 2, 1), {})
+        version_cache.invalidate(Person, 1)
+        self.assertIsNone(version_cache.get((Person, 1, 1)))
+        self.assertIsNone(version_cache.get((Person, 1, 2)))
+        self.assertIsNotNone(version_cache.get((Person, 2, 1)))
+        # evicted entries leave the index of records too
+        for version_id in range(1, 5):
+            version_cache.set((Person, 3, version_id), {})
+        self.assertEqual(len(version_cache._records[(Person, 3)]), 3)
+
+    def test_should_return_copies(self):
+        version_cache = VersionCache()
+        version_cache.set('a', {'name': 'a'})
+        version_cache.get('a')['name'] = 'b'
+        self.assertEqual(version_cache.get('a'), {'name': 'a'})
+
+
+class TestCachedVersions(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        cache.clear()
+        self.person = Person.create(name='version 1')
+        self.person.name = 'version 2'
+        self.person.save()
+
+    def tearDown(self):
+        Person.drop_table()
+
+    def test_get_version_should_hit_cache(self):
+        self.assertEqual(self.person.get_version(1).name, 'version 1')
+        self.assertEqual(cache.stats, {'hits': 0, 'misses': 1, 'size': 1})
+        version = self.person.get_version(1)
+        self.assertEqual(version.name, 'version 1')
+        self.assertEqual(version._version_id, 1)
+        self.assertIsNotNone(version._valid_until)
+        self.assertFalse(version.is_dirty())
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_get_version_should_raise_for_unknown_version(self):
+        self.assertRaises(Person._VersionModel.DoesNotExist, self.person.get_version, 3)
+
+    def test_should_not_cache_current_version(self):
+        self.assertIsNone(self.person.get_version(2)._valid_until)
+        self.person.get_version(1)
+        self.assertEqual(len(cache), 1)
+        self.person.name = 'version 3'
+        self.person.save()
+        self.assertIsNotNone(self.person.get_version(2)._valid_until)
+
+    def test_should_not_cache_inside_transaction(self):
+        with database.atomic() as transaction:
+            self.person.name = 'version 3'
+            self.person.save()
+            self.assertIsNotNone(self.person.get_version(2)._valid_until)
+            transaction.rollback()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(self.person.get_version(2)._valid_until)
+
+    def test_should_not_serve_versions_of_deleted_record_with_reused_id(self):
+        other = Person.create(name='old-b')
+        other.name = 'changed'
+        other.save()
+        self.assertEqual(other.get_version(1).name, 'old-b')
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            other.delete_instance()
+            # SQLite hands out the highest id again
+            reused = Person.create(name='new-b')
+            reused.name = 'changed'
+            reused.save()
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        self.assertEqual(reused.id, other.id)
+        self.assertEqual(reused.get_version(1).name, 'new-b')
+
+    def test_revert_should_use_cache(self):
+        self.person.get_version(1)
+        self.person.revert(1)
+        self.assertEqual(self.person.name, 'version 1')
+        self.assertEqual(cache.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import datetime
+import unittest
+
+from peewee import CharField, SqliteDatabase
+
+from . import VersionedModel
+from .cdc import BackpressureError, ChangeFeed, DELETE, INSERT, UPDATE, get_checkpoint_model
+
+database = SqliteDatabase(':memory:')
+
+
+class BaseClass(VersionedModel):
+
+    class Meta:
+        database = database
+
+
+class Person(BaseClass):
+    name = CharField()
+
+
+class Pet(BaseClass):
+    name = CharField()
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        Pet.create_table()
+        self.person = Person.create(name='Mike')
+        self.person.name = 'Mighty Mike'
+        self.person.save()
+        self.pet = Pet.create(name='Rex')
+        self.person.delete_instance()
+
+    def tearDown(self):
+        Person.drop_table()
+        Pet.drop_table()
+        get_checkpoint_model(database).drop_table(fail_silently=True)
+
+    def summarize(self, batch):
+        return [(event.type, event.model, event.version.name) for event in batch]
+
+    def test_should_return_all_events(self):
+        feed = ChangeFeed('test', [Person, Pet])
+        self.assertEqual(self.summarize(feed.poll()), [
+            (INSERT, Person, 'Mike'),
+            (UPDATE, Person, 'Mighty Mike'),
+            (DELETE, Person, 'Mighty Mike'),
+            (INSERT, Pet, 'Rex'),
+        ])
+        self.assertEqual(feed.poll(), [])
+
+    def test_should_return_record_id(self):
+        feed = ChangeFeed('test', [Pet])
+        self.assertEqual(feed.poll()[0].record_id, self.pet.id)
+
+    def test_should_return_record_id_of_deleted_records(self):
+        # Deleting sets ``_original_record_id`` to NULL on databases enforcing foreign keys
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            self.pet.delete_instance()
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        feed = ChangeFeed('test', [Pet])
+        self.assertEqual([(event.type, event.record_id) for event in feed.poll()],
+                         [(INSERT, self.pet.id), (DELETE, self.pet.id)])
+
+    def test_should_not_starve_later_models(self):
+        feed = ChangeFeed('test', [Person, Pet], batch_size=1)
+        self.assertEqual(self.summarize(feed.poll()), [(INSERT, Person, 'Mike')])
+        self.assertEqual(self.summarize(feed.poll()), [(INSERT, Pet, 'Rex')])
+        self.assertEqual(self.summarize(feed.poll()), [(UPDATE, Person, 'Mighty Mike')])
+
+    def test_should_wait_for_missing_ids(self):
+        VersionModel = Person._VersionModel
+        # The row of a transaction that has not committed yet
+        VersionModel.delete().where(VersionModel._version_id == 2).execute()
+        feed = ChangeFeed('test', [Person], gap_timeout=60)
+        self.assertEqual(self.summarize(feed.poll()), [(INSERT, Person, 'Mike')])
+        self.assertEqual(feed.poll(), [])
+
+        # Rows after an old gap don't wait
+        VersionModel.update(_valid_from=datetime.datetime(2016, 4, 24)).execute()
+        self.assertEqual(self.summarize(feed.poll()), [(DELETE, Person, 'Mighty Mike')])
+
+    def test_should_skip_gaps_after_timeout(self):
+        VersionModel = Person._VersionModel
+        VersionModel.delete().where(VersionModel._version_id == 2).execute()
+        feed = ChangeFeed('test', [Person], gap_timeout=0)
+        self.assertEqual(self.summarize(feed.poll()), [
+            (INSERT, Person, 'Mike'),
+            (DELETE, Person, 'Mighty Mike'),
+        ])
+
+    def test_should_return_batches(self):
+        feed = ChangeFeed('test', [Person, Pet], batch_size=3)
+        batches = [self.summarize(batch) for batch in feed]
+        self.assertEqual([len(batch) for batch in batches], [3, 1])
+        self.assertEqual(batches[1], [(INSERT, Pet, 'Rex')])
+
+    def test_should_filter_event_types(self):
+        feed = ChangeFeed('test', [Person, Pet], events=(INSERT, DELETE))
+        self.assertEqual(self.summarize(feed.poll()), [
+            (INSERT, Person, 'Mike'),
+            (DELETE, Person, 'Mighty Mike'),
+            (INSERT, Pet, 'Rex'),
+        ])
+        # skipped events are not returned later on
+        Pet.create(name='Tom')
+        self.assertEqual(self.summarize(feed.poll()), [(INSERT, Pet, 'Tom')])
+
+    def test_should_resume_from_committed_checkpoint(self):
+        feed = ChangeFeed('test', [Person, Pet], batch_size=2)
+        feed.poll()
+        feed.commit()
+        feed.poll()
+
+        # A new consumer with the same name continues after the commit
+        feed = ChangeFeed('test', [Person, Pet], batch_size=2)
+        self.assertEqual(self.summarize(feed.poll()), [
+            (DELETE, Person, 'Mighty Mike'),
+            (INSERT, Pet, 'Rex'),
+        ])
+        # Other consumers have their own checkpoints
+        self.assertEqual(len(ChangeFeed('other', [Person, Pet]).poll()), 4)
+
+    def test_rollback_should_return_events_again(self):
+        feed = ChangeFeed('test', [Pet])
+        self.assertEqual(len(feed.poll()), 1)
+        feed.rollback()
+        self.assertEqual(len(feed.poll()), 1)
+
+    def test_should_apply_backpressure(self):
+        feed = ChangeFeed('test', [Person, Pet], batch_size=2, max_pending=2)
+        feed.poll()
+        self.assertRaises(BackpressureError, feed.poll)
+        feed.commit()
+        self.assertEqual(len(feed.poll()), 2)
+
+    def test_follow_should_return_new_changes(self):
+        feed = ChangeFeed('test', [Pet])
+        polls = []
+
+        def stop():
+            polls.append(None)
+            if len(polls) == 2:
+                Pet.create(name='Tom')
+            return len(polls) > 3
+
+        batches = [self.summarize(batch) for batch in feed.follow(poll_interval=0, stop=stop)]
+        self.assertEqual(batches, [[(INSERT, Pet, 'Rex')], [(INSERT, Pet, 'Tom')]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import datetime
+import unittest
+
+from peewee import CharField, SqliteDatabase
+
+from . import VersionedModel
+from .check import (check, INVALID_RANGE, MISSING_VERSION, MULTIPLE_CURRENT, ORPHANED,
+                    UNLINKED, VERSION_GAPS)
+from .recovery import rebuild
+
+database = SqliteDatabase(':memory:')
+
+
+class Person(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = database
+
+
+class TestCheck(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        self.people = [Person.create(name=str(i)) for i in range(5)]
+        for person in self.people:
+            person.name += ' changed'
+            person.save()
+        self.VersionModel = Person._VersionModel
+
+    def tearDown(self):
+        Person.drop_table()
+
+    def summarize(self, violations):
+        return dict((violation.check, (violation.count, violation.sample_ids, violation.repaired))
+                    for violation in violations)
+
+    def version(self, person, version_id):
+        VersionModel = self.VersionModel
+        return VersionModel.get((VersionModel._original_record == person) &
+                                (VersionModel._version_id == version_id))
+
+    def test_should_find_nothing_in_consistent_history(self):
+        self.people[0].delete_instance()
+        self.assertEqual(check([Person]), [])
+
+    def test_should_find_nothing_after_undelete_with_foreign_keys_enforced(self):
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            self.people[0].delete_instance()
+            self.assertEqual(check([Person]), [])
+            Person.undelete([self.people[0].id])
+            self.assertEqual(check([Person]), [])
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+
+    def test_should_find_nothing_when_id_is_reused(self):
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            person = self.people[4]
+            person.delete_instance()
+            # SQLite hands out the highest id again
+            reused = Person.create(name='new')
+            self.assertEqual(reused.id, person.id)
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        self.assertEqual(check([Person], repair=True), [])
+        self.assertEqual(reused._get_current_version().name, 'new')
+        self.assertIsNone(reused._get_current_version()._valid_until)
+
+    def test_should_still_check_record_with_reused_id(self):
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            self.people[4].delete_instance()
+            reused = Person.create(name='new')
+            reused.name = 'changed'
+            reused.save()
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        VersionModel = self.VersionModel
+        VersionModel.update(_valid_until=None).where(VersionModel._original_record == reused).execute()
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {MULTIPLE_CURRENT: (1, [reused.id], 1)})
+        self.assertEqual(check([Person]), [])
+        # the deleted record's tombstone is left alone
+        self.assertEqual(Person.deleted().count(), 0)
+        self.assertEqual(VersionModel.select().where(VersionModel._deleted == True).get()._valid_until, None)
+
+    def test_multiple_current(self):
+        VersionModel = self.VersionModel
+        VersionModel.update(_valid_until=None).where(
+            VersionModel._original_record << [self.people[1], self.people[3]]).execute()
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {MULTIPLE_CURRENT: (2, [self.people[1].id, self.people[3].id], 2)})
+        self.assertEqual(check([Person]), [])
+        self.assertEqual(self.people[1].version_id, 2)
+        self.assertEqual(self.version(self.people[1], 1)._valid_until,
+                         self.version(self.people[1], 2)._valid_from)
+
+    def test_version_gaps(self):
+        VersionModel = self.VersionModel
+        VersionModel.update(_version_id=5).where(
+            (VersionModel._original_record == self.people[2]) & (VersionModel._version_id == 2)).execute()
+        self.assertEqual(self.summarize(check([Person], sample_size=1, repair=True)),
+                         {VERSION_GAPS: (1, [self.people[2].id], 1)})
+        self.assertEqual(self.people[2].version_id, 2)
+
+    def test_version_gaps_with_duplicate_first_version(self):
+        VersionModel = self.VersionModel
+        person = self.people[2]
+        person.name = 'third'
+        person.save()
+        # versions 1, 1, 3: renumbering moves rows forward in the index it reads
+        VersionModel.update(_version_id=1).where(
+            (VersionModel._original_record == person) & (VersionModel._version_id == 2)).execute()
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {VERSION_GAPS: (1, [person.id], 1)})
+        self.assertEqual([version_id for version_id, in VersionModel
+                          .select(VersionModel._version_id)
+                          .where(VersionModel._original_record == person)
+                          .order_by(VersionModel._id)
+                          .tuples()], [1, 2, 3])
+        self.assertEqual(check([Person]), [])
+
+    def test_missing_version(self):
+        VersionModel = self.VersionModel
+        person = Person.create(name='new')
+        VersionModel.delete().where(VersionModel._original_record == person).execute()
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {MISSING_VERSION: (1, [person.id], 1)})
+        self.assertEqual(person.version_id, 1)
+        self.assertEqual(check([Person]), [])
+
+    def test_orphaned_is_only_reported(self):
+        Person.delete().where(Person.id == self.people[4].id).execute()
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {ORPHANED: (1, [self.people[4].id], 0)})
+        # no deleted version is written, so ``rebuild()`` can still restore the record
+        VersionModel = self.VersionModel
+        self.assertEqual(VersionModel.select().where(VersionModel._record_id == self.people[4].id).count(), 2)
+        self.assertEqual(rebuild(Person), 1)
+        self.assertEqual(check([Person]), [])
+
+    def test_unlinked_can_not_be_repaired(self):
+        VersionModel = self.VersionModel
+        person = self.people[0]
+        version = person._get_current_version()
+        Person.delete().where(Person.id == person.id).execute()
+        # Versions written before ``_record_id`` existed
+        (VersionModel
+         .update(_original_record=None, _record_id=None)
+         .where(VersionModel._original_record == person)
+         .execute())
+        self.assertEqual(self.summarize(check([Person], repair=True)),
+                         {UNLINKED: (1, [version._id], 0)})
+
+    def test_invalid_range(self):
+        VersionModel = self.VersionModel
+        version = self.version(self.people[0], 1)
+        version._valid_until = version._valid_from - datetime.timedelta(seconds=1)
+        version.save()
+        self.assertEqual(self.summarize(check([Person], checks=[INVALID_RANGE])),
+                         {INVALID_RANGE: (1, [version._id], 0)})
+        check([Person], repair=True, batch_size=1)
+        self.assertEqual(self.version(self.people[0], 1)._valid_until, version._valid_from)
+
+    def test_should_repair_in_batches(self):
+        VersionModel = self.VersionModel
+        VersionModel.update(_valid_until=None).execute()
+        violations = check([Person], repair=True, batch_size=2)
+        self.assertEqual(self.summarize(violations)[MULTIPLE_CURRENT][2], 5)
+        self.assertEqual(check([Person]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
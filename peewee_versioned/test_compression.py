@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from peewee import BlobField, CharField, TextField, SqliteDatabase
+
+from . import VersionedModel
+from .compression import MARKER, compress_history, decompress_value
+
+database = SqliteDatabase(':memory:')
+
+LONG_TEXT = u'Lorem ipsum dolor sit amet, éè ' * 100
+LONG_BLOB = b'\x00\x01\x02\x03' * 500
+
+
+class Document(VersionedModel):
+    title = CharField()
+    body = TextField(null=True)
+    attachment = BlobField(null=True)
+
+    class Meta:
+        database = database
+        compressed_fields = {'body': 100, 'attachment': 100}
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        Document.create_table()
+        self.document = Document.create(title='title', body=LONG_TEXT, attachment=LONG_BLOB)
+
+    def tearDown(self):
+        Document.drop_table()
+
+    def get_raw_version(self, version_id=1):
+        VersionModel = Document._VersionModel
+        return (VersionModel
+                .select()
+                .where(VersionModel._version_id == version_id)
+                .dicts()
+                .get())
+
+    def test_should_store_compressed_values(self):
+        raw = self.get_raw_version()
+        self.assertTrue(raw['body'].startswith(MARKER))
+        self.assertLess(len(raw['body']), len(LONG_TEXT))
+        self.assertLess(len(bytes(raw['attachment'])), len(LONG_BLOB))
+
+    def test_should_not_compress_live_table(self):
+        document = Document.get(Document.id == self.document.id)
+        self.assertEqual(document.body, LONG_TEXT)
+        self.assertEqual(bytes(document.attachment), LONG_BLOB)
+
+    def test_should_decompress_on_access(self):
+        version = self.document._get_current_version()
+        self.assertEqual(version.body, LONG_TEXT)
+        self.assertEqual(bytes(version.attachment), LONG_BLOB)
+        self.assertEqual(version.title, 'title')
+
+    def test_should_not_compress_small_values(self):
+        self.document.body = 'short'
+        self.document.save()
+        self.assertEqual(self.get_raw_version(2)['body'], 'short')
+        self.assertEqual(self.document.get_version(2).body, 'short')
+
+    def test_should_always_compress_values_looking_compressed(self):
+        self.document.body = MARKER + 'abc'
+        self.document.save()
+        self.assertNotEqual(self.get_raw_version(2)['body'], MARKER + 'abc')
+        self.assertEqual(self.document.get_version(2).body, MARKER + 'abc')
+
+    def test_should_keep_null(self):
+        self.document.body = None
+        self.document.save()
+        self.assertIsNone(self.document.get_version(2).body)
+
+    def test_revert_should_decompress(self):
+        self.document.body = 'short'
+        self.document.attachment = None
+        self.document.save()
+        self.document.revert(1)
+        document = Document.get(Document.id == self.document.id)
+        self.assertEqual(document.body, LONG_TEXT)
+        self.assertEqual(bytes(document.attachment), LONG_BLOB)
+
+    def test_undelete_should_decompress(self):
+        self.document.delete_instance()
+        Document.undelete([self.document.id])
+        document = Document.get(Document.id == self.document.id)
+        self.assertEqual(document.body, LONG_TEXT)
+        self.assertEqual(bytes(document.attachment), LONG_BLOB)
+        # the new version is stored compressed
+        self.assertTrue(self.get_raw_version(3)['body'].startswith(MARKER))
+        self.assertEqual(document._get_current_version().body, LONG_TEXT)
+
+    def test_compress_history(self):
+        VersionModel = Document._VersionModel
+        field = VersionModel._meta.fields['body']
+        # Simulate history written before compression was enabled
+        VersionModel.update(body=LONG_TEXT + 'x', attachment=None).execute()
+        for i in range(5):
+            VersionModel.insert(title=str(i), body=LONG_TEXT, _version_id=i + 2).execute()
+
+        self.assertEqual(compress_history(Document, batch_size=2), 6)
+        for body, in VersionModel.select(VersionModel.body).tuples():
+            self.assertTrue(body.startswith(MARKER))
+        self.assertEqual(decompress_value(field, self.get_raw_version()['body']), LONG_TEXT + 'x')
+
+        # Running it again has nothing left to do
+        self.assertEqual(compress_history(Document), 0)
+
+    def test_compress_history_should_compress_values_looking_compressed(self):
+        VersionModel = Document._VersionModel
+        # Written before compression was enabled, not an actual compressed value
+        VersionModel.update(body=MARKER + 'abc', attachment=b'zlib:abc').execute()
+        version = self.document._get_current_version()
+        self.assertEqual(version.body, MARKER + 'abc')
+        self.assertEqual(bytes(version.attachment), b'zlib:abc')
+
+        self.assertEqual(compress_history(Document), 1)
+        self.assertNotEqual(self.get_raw_version()['body'], MARKER + 'abc')
+        version = self.document._get_current_version()
+        self.assertEqual(version.body, MARKER + 'abc')
+        self.assertEqual(bytes(version.attachment), b'zlib:abc')
+        self.assertEqual(compress_history(Document), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import datetime
 import os
 import unittest
 
@@ -9,6 +10,7 @@ from playhouse.reflection import Introspector
 
 from . import VersionedModel
 from . import migrate
+from .migrate import normalize_timestamps, estimate_rows, PlannedOperation
 
 # Setup Database
 database_url = os.environ.get('DATABASE', None)
@@ -254,5 +256,143 @@ class TestMigrations(unittest.TestCase):
         self.assertFalse(models['food'].name.index)
         self.assertFalse(models['foodversion'].name.index)
 
+
+class TestDryRun(unittest.TestCase):
+
+    def setUp(self):
+        Food.create_table()
+        Menu.create_table()
+        for i in range(3):
+            food = Food.create(name=str(i), is_tasty=True)
+            food.name = 'new name'
+            food.save()
+
+    def tearDown(self):
+        Food.drop_table()
+        Menu.drop_table()
+
+    def test_should_not_run(self):
+        another_column = CharField(null=True)
+        migrate(migrator.add_column('food', 'another_column', another_column),
+                migrator.rename_table('food', 'chow'),
+                dry_run=True)
+        models = introspector.generate_models()
+        self.assertIn('food', models)
+        self.assertNotIn('another_column', models['food']._meta.fields)
+        self.assertNotIn('another_column', models['foodversion']._meta.fields)
+
+    @unittest.skipIf(database_url, 'estimates are only exact on SQLite')
+    def test_should_plan_version_table(self):
+        another_column = CharField(null=True)
+        plan = migrate(migrator.add_column('food', 'another_column', another_column), dry_run=True)
+        self.assertEqual([(step.method, step.table, step.estimated_rows) for step in plan],
+                         [('add_column', 'food', 3), ('add_column', 'foodversion', 6)])
+        self.assertEqual(plan[1].args, ('foodversion', 'another_column', another_column))
+
+    def test_should_plan_index_without_introspection(self):
+        generate_models = Introspector.generate_models
+        Introspector.generate_models = None
+        try:
+            plan = migrate(migrator.add_index('food', ['name']), dry_run=True)
+        finally:
+            Introspector.generate_models = generate_models
+        self.assertEqual([(step.method, step.table) for step in plan], [('add_index', 'food')])
+
+    def test_should_not_plan_version_table_for_foreign_key(self):
+        another_column = ForeignKeyField(Menu, related_name='food', null=True, to_field=Menu.id)
+        plan = migrate(migrator.add_column('food', 'another_column', another_column),
+                       migrator.add_index('food', ['name']),
+                       dry_run=True)
+        self.assertEqual([(step.method, step.table) for step in plan],
+                         [('add_column', 'food'), ('add_index', 'food')])
+
+    @unittest.skipIf(database_url, 'estimates are only exact on SQLite')
+    def test_should_plan_rename_table(self):
+        plan = migrate(migrator.rename_table('food', 'chow'), dry_run=True)
+        self.assertEqual(plan, [
+            PlannedOperation('drop_column', 'foodversion', ('foodversion', '_original_record_id'), 6),
+            PlannedOperation('rename_table', 'food', ('food', 'chow'), 3),
+            PlannedOperation('rename_table', 'foodversion', ('foodversion', 'chowversion'), 6),
+            PlannedOperation('add_column', 'chowversion', ('chowversion', '_original_record_id'), 6),
+            PlannedOperation('relink', 'chowversion', ('chowversion', 'chow'), 6),
+        ])
+
+    @unittest.skipIf(database_url, 'statistics are only exact on SQLite')
+    def test_estimate_rows_should_use_statistics(self):
+        models = introspector.generate_models()
+        self.assertEqual(estimate_rows(models['foodversion']), 6)
+        # without statistics the highest rowid is used, the rows aren't counted
+        Food._VersionModel.delete().where(Food._VersionModel._id == 1).execute()
+        self.assertEqual(estimate_rows(models['foodversion']), 6)
+        database.execute_sql('ANALYZE')
+        # an estimate that differs from the real count shows the statistics are used
+        database.execute_sql("UPDATE sqlite_stat1 SET stat = '100 1' WHERE tbl = 'foodversion'")
+        self.assertEqual(estimate_rows(models['foodversion']), 100)
+
+
+class TestNormalizeTimestamps(unittest.TestCase):
+
+    def setUp(self):
+        Food.create_table()
+        self.food = Food.create(name='apple', is_tasty=True)
+        for name in ('pear', 'plum'):
+            self.food.name = name
+            self.food.save()
+        self.other = Food.create(name='kiwi', is_tasty=False)
+
+        # Versions as written by older releases: local ``_valid_from``, separately read ``_valid_until``
+        VersionModel = Food._VersionModel
+        for version in VersionModel.select():
+            start = datetime.datetime(2016, 4, 24, version._version_id)
+            version._valid_from = start
+            if version._valid_until is not None:
+                version._valid_until = start + datetime.timedelta(minutes=59, seconds=58)
+            version.save()
+
+    def tearDown(self):
+        Food.drop_table()
+
+    def get_ranges(self, food):
+        return [(version._valid_from, version._valid_until) for version in food.get_versions()]
+
+    def test_should_chain_versions(self):
+        self.assertEqual(normalize_timestamps(Food, batch_size=2), 2)
+        hour = lambda hour: datetime.datetime(2016, 4, 24, hour)
+        self.assertEqual(self.get_ranges(self.food), [(hour(1), hour(2)), (hour(2), hour(3)), (hour(3), None)])
+        self.assertEqual(self.get_ranges(self.other), [(hour(1), None)])
+        self.assertEqual(normalize_timestamps(Food), 0)
+
+    def test_should_shift_valid_from(self):
+        normalize_timestamps(Food, valid_from_offset=datetime.timedelta(hours=-1))
+        hour = lambda hour: datetime.datetime(2016, 4, 24, hour - 1)
+        self.assertEqual(self.get_ranges(self.food), [(hour(1), hour(2)), (hour(2), hour(3)), (hour(3), None)])
+
+    def test_should_shift_keeping_fractions_of_seconds(self):
+        VersionModel = Food._VersionModel
+        moment = datetime.datetime(2016, 4, 24, 23, 59, 59, 123456)
+        VersionModel.update(_valid_from=moment).where(VersionModel._original_record == self.other).execute()
+        self.assertEqual(normalize_timestamps(Food, valid_from_offset=datetime.timedelta(days=1, hours=2)), 4)
+        self.assertEqual(self.get_ranges(self.other), [(moment + datetime.timedelta(days=1, hours=2), None)])
+
+    def test_should_chain_versions_of_deleted_records(self):
+        if not database_url:
+            # ``_original_record_id`` is set to NULL on delete like on databases enforcing foreign keys
+            database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            self.food.delete_instance()
+        finally:
+            if not database_url:
+                database.execute_sql('PRAGMA foreign_keys = OFF')
+        normalize_timestamps(Food)
+        VersionModel = Food._VersionModel
+        versions = list(VersionModel
+                        .select()
+                        .where(VersionModel._record_id == self.food.id)
+                        .order_by(VersionModel._version_id))
+        self.assertEqual([version._original_record_id for version in versions], [None] * 4)
+        for previous, version in zip(versions, versions[1:]):
+            self.assertEqual(previous._valid_until, version._valid_from)
+
+
 if __name__ == '__main__':
     unittest.main()
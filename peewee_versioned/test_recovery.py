@@ -0,0 +1,135 @@
+import datetime
+import unittest
+
+from peewee import CharField, TextField, SqliteDatabase
+
+from . import VersionedModel
+from .recovery import rebuild
+
+database = SqliteDatabase(':memory:')
+
+
+class BaseClass(VersionedModel):
+
+    class Meta:
+        database = database
+
+
+class Person(BaseClass):
+    name = CharField()
+
+
+class Document(BaseClass):
+    body = TextField()
+
+    class Meta:
+        compressed_fields = {'body': 10}
+
+
+class TestRebuild(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        Document.create_table()
+        self.people = [Person.create(name=str(i)) for i in range(10)]
+        for person in self.people[:5]:
+            person.name += ' changed'
+            person.save()
+        self.people[9].delete_instance()
+
+    def tearDown(self):
+        Person.drop_table()
+        Document.drop_table()
+
+    def names(self):
+        return dict(Person.select(Person.id, Person.name).tuples())
+
+    def test_should_rebuild_truncated_table(self):
+        expected = self.names()
+        Person.delete().execute()
+
+        self.assertEqual(rebuild(Person, batch_size=3), 9)
+        self.assertEqual(self.names(), expected)
+        # history is untouched
+        self.assertEqual(self.people[0].version_id, 2)
+
+    def test_should_rebuild_with_foreign_keys_enforced(self):
+        # Deleting the rows sets ``_original_record_id`` of their versions to NULL
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            expected = self.names()
+            Person.delete().execute()
+            VersionModel = Person._VersionModel
+            self.assertEqual(VersionModel.select().where(
+                (VersionModel._record_id == self.people[0].id) &
+                VersionModel._original_record.is_null(False)).count(), 0)
+
+            self.assertEqual(rebuild(Person, batch_size=3), 9)
+            self.assertEqual(self.names(), expected)
+            self.assertEqual([version.name for version in self.people[0].get_versions()], ['0', '0 changed'])
+            # the deleted record stays deleted
+            self.assertEqual([version._record_id for version in Person.deleted()], [self.people[9].id])
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+
+    def test_should_rebuild_as_of_with_foreign_keys_enforced(self):
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            Person.delete().execute()
+            self.assertEqual(rebuild(Person, as_of=datetime.datetime.utcnow()), 9)
+            person = Person.get(Person.id == self.people[0].id)
+            self.assertEqual(person.name, '0 changed')
+            self.assertEqual(person.version_id, 2)
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+
+    def test_should_skip_existing_rows(self):
+        Person.delete().where(Person.id > 5).execute()
+        Person.update(name='kept').where(Person.id == 1).execute()
+
+        self.assertEqual(rebuild(Person), 4)
+        self.assertEqual(self.names()[1], 'kept')
+        self.assertEqual(len(self.names()), 9)
+
+    def test_should_rebuild_id_range(self):
+        Person.delete().execute()
+        self.assertEqual(rebuild(Person, start_id=3, end_id=6), 3)
+        self.assertEqual(sorted(self.names()), [3, 4, 5])
+
+    def test_should_rebuild_as_of(self):
+        VersionModel = Person._VersionModel
+        moment = datetime.datetime(2016, 4, 24)
+        VersionModel.update(_valid_from=moment - datetime.timedelta(days=1)).where(
+            VersionModel._version_id == 1).execute()
+        VersionModel.update(_valid_until=moment + datetime.timedelta(days=1)).where(
+            VersionModel._version_id == 1, VersionModel._valid_until.is_null(False)).execute()
+        VersionModel.update(_valid_from=moment + datetime.timedelta(days=1)).where(
+            VersionModel._version_id == 2).execute()
+        Person.delete().execute()
+
+        self.assertEqual(rebuild(Person, as_of=moment), 10)
+        self.assertEqual(sorted(self.names().values()), sorted(str(i) for i in range(10)))
+
+        # Records restored to an older version get a new version
+        person = Person.get(Person.id == self.people[0].id)
+        self.assertEqual(person.version_id, 3)
+        self.assertEqual(person.get_version(2)._valid_until, person._get_current_version()._valid_from)
+        # The deleted record is restored as well
+        deleted = Person.get(Person.id == self.people[9].id)
+        self.assertEqual(deleted.version_id, 3)
+        self.assertFalse(deleted._get_current_version()._deleted)
+        # Untouched records keep their version
+        self.assertEqual(Person.get(Person.id == self.people[7].id).version_id, 1)
+
+    def test_should_decompress_compressed_fields(self):
+        document = Document.create(body='a long body ' * 10)
+        Document.delete().execute()
+        self.assertEqual(rebuild(Document), 1)
+        self.assertEqual(Document.get(Document.id == document.id).body, 'a long body ' * 10)
+
+    def test_should_restore_nothing_without_history(self):
+        self.assertEqual(rebuild(Document), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
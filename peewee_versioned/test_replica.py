@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from peewee import CharField, SqliteDatabase
+
+from . import VersionCache, VersionedModel
+
+# Two files stand in for a primary and its replica, the tests do the replication
+primary = SqliteDatabase(None)
+replica = SqliteDatabase(None)
+
+
+class Person(VersionedModel):
+    name = CharField()
+
+    class Meta:
+        database = primary
+        history_database = replica
+
+
+class TestHistoryDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        primary.init(os.path.join(self.directory, 'primary.db'))
+        replica.init(os.path.join(self.directory, 'replica.db'))
+        Person.create_table()
+        self.person = Person.create(name='Tom')
+        self.replicate()
+
+    def tearDown(self):
+        Person.drop_table()
+        primary.close()
+        if not replica.is_closed():
+            replica.close()
+        shutil.rmtree(self.directory)
+
+    def replicate(self):
+        if not replica.is_closed():
+            replica.close()
+        shutil.copy(primary.database, replica.database)
+
+    def test_reads_should_go_to_history_database(self):
+        self.person.name = 'Mike'
+        self.person.save()
+
+        # not replicated yet
+        self.assertEqual(self.person.version_id, 1)
+        self.assertEqual(len(self.person.get_versions()), 1)
+        self.assertEqual(len(Person.get_history()), 1)
+        with self.assertRaises(Person._VersionModel.DoesNotExist):
+            self.person.get_version(2)
+
+        self.replicate()
+        self.assertEqual(self.person.version_id, 2)
+        self.assertEqual(self.person.get_version(2).name, 'Mike')
+        self.assertEqual([version.name for version in self.person.get_versions()], ['Tom', 'Mike'])
+        self.assertEqual(len(Person.get_history()), 2)
+
+    def test_writes_should_go_to_primary(self):
+        self.person.name = 'Mike'
+        self.person.save()
+        self.person.delete_instance()
+
+        VersionModel = Person._VersionModel
+        versions = list(VersionModel.select().order_by(VersionModel._version_id))
+        self.assertEqual([version.name for version in versions], ['Tom', 'Mike', 'Mike'])
+        self.assertEqual(versions[-1]._deleted, True)
+        self.assertEqual(sum(1 for version in versions if version._valid_until is None), 1)
+
+    def test_transaction_should_read_its_own_writes(self):
+        with primary.atomic():
+            self.person.name = 'Mike'
+            self.person.save()
+            self.assertEqual(self.person.version_id, 2)
+            self.assertEqual(self.person.get_version(2).name, 'Mike')
+            self.assertEqual(len(Person.get_history()), 2)
+
+        # outside the transaction reads go back to the replica
+        self.assertEqual(self.person.version_id, 1)
+
+    def test_revert_should_use_primary_versions(self):
+        self.person.name = 'Mike'
+        self.person.save()
+        self.replicate()
+        self.person.name = 'Bob'
+        self.person.save()
+
+        # the replica still thinks 'Mike' is the current version
+        self.person.revert(-1)
+        self.assertEqual(self.person.name, 'Mike')
+        self.replicate()
+        self.assertEqual(self.person.version_id, 4)
+        self.assertEqual([version.name for version in self.person.get_versions()], ['Tom', 'Mike', 'Bob', 'Mike'])
+
+    def test_should_not_cache_versions_open_on_the_replica(self):
+        cache = VersionCache()
+        Person._meta.version_cache = cache
+        try:
+            self.person.name = 'Mike'
+            self.person.save()
+            # version 1 is still current on the replica
+            self.assertIsNone(self.person.get_version(1)._valid_until)
+            self.assertEqual(len(cache), 0)
+            self.replicate()
+            self.assertIsNotNone(self.person.get_version(1)._valid_until)
+            self.assertEqual(len(cache), 1)
+        finally:
+            del Person._meta.version_cache
@@ -0,0 +1,180 @@
+import datetime
+import logging
+import unittest
+
+from peewee import CharField, ForeignKeyField, TextField, SqliteDatabase
+
+from . import VersionedModel
+from .snapshot import Snapshot
+
+database = SqliteDatabase(':memory:')
+
+
+class BaseClass(VersionedModel):
+
+    class Meta:
+        database = database
+
+
+class Owner(BaseClass):
+    name = CharField()
+
+
+class Pet(BaseClass):
+    name = CharField()
+    owner = ForeignKeyField(Owner, null=True, related_name='pets')
+    notes = TextField(null=True)
+
+    class Meta:
+        compressed_fields = {'notes': 10}
+
+
+def day(number):
+    return datetime.datetime(2016, 4, number)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        Owner.create_table()
+        Pet.create_table()
+        self.owner = Owner.create(name='Mike')
+        self.snapshot = Snapshot(Pet)
+
+    def tearDown(self):
+        self.snapshot.drop()
+        Pet.drop_table()
+        Owner.drop_table()
+
+    def set_validity(self, pet, version_id, valid_from, valid_until):
+        VersionModel = Pet._VersionModel
+        (VersionModel
+         .update(_valid_from=valid_from, _valid_until=valid_until)
+         .where((VersionModel._record_id == pet.id) & (VersionModel._version_id == version_id))
+         .execute())
+
+    def make_history(self):
+        '''
+        rex:   day 1 'Rex'   -> day 3 'Rex II' -> current
+        tom:   day 2 'Tom'   -> day 4 deleted
+        felix: day 5 'Felix' -> current
+        '''
+        rex = Pet.create(name='Rex', owner=self.owner, notes='a long note ' * 10)
+        tom = Pet.create(name='Tom')
+        felix = Pet.create(name='Felix')
+
+        rex.name = 'Rex II'
+        rex.save()
+        tom.delete_instance()
+
+        self.set_validity(rex, 1, day(1), day(3))
+        self.set_validity(rex, 2, day(3), None)
+        self.set_validity(tom, 1, day(2), day(4))
+        self.set_validity(tom, 2, day(4), None)
+        self.set_validity(felix, 1, day(5), None)
+        return rex, tom, felix
+
+    def names(self):
+        Model = self.snapshot.model
+        return sorted(pet.name for pet in Model.select())
+
+    def test_should_materialize_state_at_timestamp(self):
+        rex, tom, felix = self.make_history()
+        self.snapshot.refresh(day(2))
+        self.assertEqual(self.names(), ['Rex', 'Tom'])
+        self.assertEqual(self.snapshot.as_of, day(2))
+
+        Model = self.snapshot.model
+        snapshot_rex = Model.get(Model.id == rex.id)
+        self.assertEqual(snapshot_rex._version_id, 1)
+        self.assertFalse(hasattr(snapshot_rex, 'owner'))  # Relations are not versioned
+        self.assertEqual(snapshot_rex.notes, 'a long note ' * 10)
+
+    def test_should_refresh_incrementally(self):
+        self.make_history()
+        self.snapshot.refresh(day(1))
+        self.assertEqual(self.names(), ['Rex'])
+        self.snapshot.refresh(day(3))
+        self.assertEqual(self.names(), ['Rex II', 'Tom'])
+        self.snapshot.refresh(day(6))
+        self.assertEqual(self.names(), ['Felix', 'Rex II'])
+        self.assertEqual(self.snapshot.as_of, day(6))
+
+    def test_should_handle_deleted_records_with_foreign_keys_enforced(self):
+        # Deleting tom sets ``_original_record_id`` of its versions to NULL
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            self.make_history()
+            self.snapshot.refresh(day(3))
+            self.assertEqual(self.names(), ['Rex II', 'Tom'])
+            self.snapshot.refresh(day(6))
+            self.assertEqual(self.names(), ['Felix', 'Rex II'])
+
+            earlier = Snapshot(Pet, name='petsnapshot_earlier')
+            try:
+                earlier.refresh(day(2))
+                self.assertEqual(sorted(pet.name for pet in earlier.model.select()), ['Rex', 'Tom'])
+            finally:
+                earlier.drop()
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+
+    def test_should_refresh_backwards(self):
+        self.make_history()
+        self.snapshot.refresh(day(6))
+        self.snapshot.refresh(day(2))
+        self.assertEqual(self.names(), ['Rex', 'Tom'])
+
+    def test_should_only_touch_changed_records(self):
+        rex, tom, felix = self.make_history()
+        self.snapshot.refresh(day(5))
+        # Records without versions between the timestamps are left alone
+        Model = self.snapshot.model
+        Model.update(name='untouched').where(Model.id == rex.id).execute()
+        self.snapshot.refresh(day(6))
+        self.assertEqual(self.names(), ['Felix', 'untouched'])
+
+    def test_should_apply_versions_ending_without_successor(self):
+        rex, tom, felix = self.make_history()
+        self.snapshot.refresh(day(5))
+        # A version closed without a next version, eg by a repair
+        self.set_validity(felix, 1, day(5), day(6))
+        self.snapshot.refresh(day(7))
+        self.assertEqual(self.names(), ['Rex II'])
+
+    def test_refresh_should_search_indexes(self):
+        self.make_history()
+        self.snapshot.refresh(day(2))
+        queries = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                queries.append(record.msg)
+
+        logger = logging.getLogger('peewee')
+        handler = Handler()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            self.snapshot.refresh(day(4))
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        changed = [(sql, params) for sql, params in queries if 'UNION' in sql]
+        self.assertEqual(len(changed), 2)
+        for sql, params in changed:
+            plan = [str(row[-1]) for row in database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)]
+            # The version table is only searched, the snapshot table may be scanned
+            self.assertEqual([step for step in plan if step.startswith('SCAN t')], [])
+            self.assertTrue(any('_valid_until>' in step for step in plan))
+
+    def test_should_keep_state_between_instances(self):
+        self.make_history()
+        self.snapshot.refresh(day(2))
+        self.assertEqual(Snapshot(Pet).as_of, day(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import sys
+import unittest
+
+import six
+from peewee import CharField, SqliteDatabase
+
+from . import VersionedModel
+from . import stats as stats_module
+from .stats import SAMPLE_RANGES, _sample_ranges, all_history_stats, get_versioned_models, history_stats
+
+database = SqliteDatabase(':memory:')
+
+
+class BaseClass(VersionedModel):
+
+    class Meta:
+        database = database
+
+
+class Person(BaseClass):
+    name = CharField()
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        # records 1..10 with 1..10 versions
+        for number in range(1, 11):
+            person = Person.create(name='0')
+            for version in range(1, number):
+                person.name = str(version)
+                person.save()
+
+    def tearDown(self):
+        Person.drop_table()
+
+    def test_get_versioned_models(self):
+        models = get_versioned_models()
+        self.assertIn(Person, models)
+        self.assertIn(BaseClass, models)
+        self.assertNotIn(Person._VersionModel, models)
+
+    def test_history_stats(self):
+        stats = history_stats(Person, top=3)
+        self.assertEqual(stats['version_rows'], 55)
+        self.assertEqual(stats['records'], 10)
+        self.assertEqual(stats['versions_per_record'],
+                         {'p50': 5, 'p90': 9, 'p99': 10, 'max': 10, 'mean': 5.5})
+        self.assertEqual(stats['hottest'], [(10, 10), (9, 9), (8, 8)])
+        today = str(Person._VersionModel.get()._valid_from.date())
+        self.assertEqual(sum(count for date, count in stats['growth_per_day']), 55)
+        self.assertIn(today, [date for date, count in stats['growth_per_day']])
+        if stats['bytes'] is not None:
+            self.assertEqual(stats['bytes_per_version'], float(stats['bytes']) / 55)
+
+    def test_history_stats_sampled(self):
+        stats = history_stats(Person, sample=0.5)
+        # records 1, 3, 5, 7 and 9
+        self.assertEqual(stats['records'], 10)
+        self.assertEqual(stats['version_rows'], 50)
+        self.assertEqual(stats['versions_per_record']['max'], 9)
+        self.assertEqual(stats['hottest'][0], (9, 9))
+
+    def test_sample_ranges(self):
+        self.assertEqual(_sample_ranges(1, 10, 0.5), [(1, 2), (3, 4), (5, 6), (7, 8), (9, 10)])
+        ranges = _sample_ranges(1, 100000, 0.1)
+        self.assertEqual(len(ranges), SAMPLE_RANGES)
+        self.assertEqual(sum(end - start for start, end in ranges), 10000)
+
+    def test_history_stats_should_count_deleted_records(self):
+        database.execute_sql('PRAGMA foreign_keys = ON')
+        try:
+            Person.get(Person.id == 10).delete_instance()
+        finally:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        # versions written before ``_record_id`` existed are left out
+        VersionModel = Person._VersionModel
+        VersionModel.update(_record_id=None).where(VersionModel._record_id == 9).execute()
+        stats = history_stats(Person, top=2)
+        self.assertEqual(stats['hottest'], [(10, 11), (8, 8)])
+        self.assertEqual(stats['records'], 9)
+
+    def test_history_stats_without_history(self):
+        Person._VersionModel.delete().execute()
+        stats = history_stats(Person)
+        self.assertEqual(stats['version_rows'], 0)
+        self.assertEqual(stats['versions_per_record'], {'max': None, 'mean': None})
+        self.assertEqual(stats['hottest'], [])
+
+    def test_all_history_stats_should_skip_missing_tables(self):
+        stats = all_history_stats(BaseClass)
+        self.assertIn('Person', stats)
+        self.assertNotIn('BaseClass', stats)
+
+    def test_main_should_print_json(self):
+        all_stats = stats_module.all_history_stats
+        # Only the models of this module, other tests leave their models behind
+        stats_module.all_history_stats = lambda **kwargs: all_stats(BaseClass, **kwargs)
+        stdout = sys.stdout
+        sys.stdout = output = six.StringIO()
+        try:
+            stats_module.main([__name__, '--top', '2'])
+        finally:
+            sys.stdout = stdout
+            stats_module.all_history_stats = all_stats
+        stats = json.loads(output.getvalue())
+        self.assertEqual(stats['Person']['versions_per_record']['p50'], 5)
+        self.assertEqual(stats['Person']['hottest'], [[10, 10], [9, 9]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import datetime
+import logging
 import os
 import inspect
 
@@ -7,6 +8,7 @@ from peewee import CharField, DateField, BooleanField, ForeignKeyField, SqliteDa
 from playhouse.db_url import connect
 
 from . import VersionedModel
+from .peewee_versioned import _LazyVersionModel
 
 database_url = os.environ.get('DATABASE', None)
 if database_url:
@@ -181,6 +183,45 @@ class TestVersionedModel(unittest.TestCase):
             self.assertEqual(current_version.version_id, version)
             self.assertEqual(self.person.version_id, version)
 
+    def test_versions_should_be_contiguous(self):
+        self.person.name = 'new name'
+        self.person.save()
+        self.person.delete_instance()
+        versions = list(Person._VersionModel.select().order_by(Person._VersionModel._version_id))
+        self.assertEqual(versions[0]._valid_until, versions[1]._valid_from)
+        self.assertEqual(versions[1]._valid_until, versions[2]._valid_from)
+        self.assertTrue(versions[2]._deleted)
+
+    def test_timestamps_should_be_utc(self):
+        before = datetime.datetime.utcnow()
+        self.person.name = 'new name'
+        self.person.save()
+        after = datetime.datetime.utcnow()
+        valid_from = self.person._get_current_version()._valid_from
+        self.assertTrue(before <= valid_from <= after)
+
+    def test_get_version_at(self):
+        self.person.name = 'new name'
+        self.person.save()
+        version_1 = self.person.get_version(1)
+        self.assertIsNone(self.person.get_version_at(version_1._valid_from - datetime.timedelta(seconds=1)))
+        self.assertEqual(self.person.get_version_at(version_1._valid_from)._version_id, 1)
+        # ranges are half open, the boundary belongs to the next version
+        self.assertEqual(self.person.get_version_at(version_1._valid_until)._version_id, 2)
+        self.assertEqual(self.person.get_version_at(datetime.datetime.utcnow())._version_id, 2)
+
+    def test_database_clock(self):
+        Person._meta.database_clock = True
+        try:
+            self.person.name = 'new name'
+            self.person.save()
+        finally:
+            del Person._meta.database_clock
+        version_1 = self.person.get_version(1)
+        version_2 = self.person.get_version(2)
+        self.assertIsInstance(version_2._valid_from, datetime.datetime)
+        self.assertEqual(version_1._valid_until, version_2._valid_from)
+
     def test_revert(self):
         version_1 = self.person_kwargs
         version_2 = version_1.copy()
@@ -253,6 +294,184 @@ class TestVersionedModel(unittest.TestCase):
             self.assertEqual(getattr(self.person, field), value)
 
 
+class TestHistoryPages(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        self.person = Person.create(name='0', birthday=datetime.date.today(), is_relative=True)
+        self.other = Person.create(name='other', birthday=datetime.date.today(), is_relative=True)
+        for name in range(1, 7):
+            self.person.name = str(name)
+            self.person.save()
+
+    def tearDown(self):
+        Person.drop_table()
+
+    def test_should_create_pagination_indexes(self):
+        VersionModel = Person._VersionModel
+        indexes = [index.columns for index in database.get_indexes(VersionModel._meta.db_table)]
+        self.assertIn(['_original_record_id', '_version_id'], indexes)
+        self.assertIn(['_valid_from', '_id'], indexes)
+
+    def test_get_versions_should_page_forward(self):
+        pages = []
+        after = None
+        while True:
+            page = self.person.get_versions(after=after, limit=3)
+            if not page:
+                break
+            pages.append([version.name for version in page])
+            after = page[-1]._version_id
+        self.assertEqual(pages, [['0', '1', '2'], ['3', '4', '5'], ['6']])
+
+    def test_get_versions_should_page_backward(self):
+        page = self.person.get_versions(before=8, limit=3)
+        self.assertEqual([version._version_id for version in page], [5, 6, 7])
+        page = self.person.get_versions(before=page[0]._version_id, limit=3)
+        self.assertEqual([version._version_id for version in page], [2, 3, 4])
+
+    def test_get_versions_between(self):
+        page = self.person.get_versions(after=2, before=5)
+        self.assertEqual([version._version_id for version in page], [3, 4])
+
+    def test_get_history_should_page_all_records(self):
+        VersionModel = Person._VersionModel
+        # Versions sharing a ``_valid_from`` are ordered by ``_id``
+        VersionModel.update(_valid_from=datetime.datetime(2016, 4, 24)).execute()
+        expected = [version._id for version in VersionModel.select().order_by(VersionModel._id)]
+        self.assertEqual(len(expected), 8)
+
+        ids = []
+        after = None
+        while True:
+            page = Person.get_history(after=after, limit=3)
+            if not page:
+                break
+            ids.extend(version._id for version in page)
+            after = (page[-1]._valid_from, page[-1]._id)
+        self.assertEqual(ids, expected)
+
+        last = Person.get_history(before=after, limit=3)
+        self.assertEqual([version._id for version in last], expected[-4:-1])
+
+    @unittest.skipIf(database_url, 'query plans are checked on SQLite')
+    def test_get_history_should_search_index(self):
+        queries = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                queries.append(record.msg)
+
+        logger = logging.getLogger('peewee')
+        handler = Handler()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            Person.get_history(after=(datetime.datetime(2016, 4, 24), 3), limit=3)
+            Person.get_history(before=(datetime.datetime(2016, 4, 24), 3), limit=3)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertEqual(len(queries), 2)
+        for sql, params in queries:
+            plan = ' '.join(str(row[-1]) for row in database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params))
+            # A range search on the index, in its order: no scan, no OR of two searches, no sort
+            self.assertIn('SEARCH', plan)
+            self.assertIn('_valid_from__id', plan)
+            for step in ('SCAN', 'MULTI-INDEX OR', 'TEMP B-TREE'):
+                self.assertNotIn(step, plan)
+
+
+class TestDeleted(unittest.TestCase):
+
+    def setUp(self):
+        Person.create_table()
+        if not database_url:
+            # ``_original_record_id`` is set to NULL on delete like on databases enforcing foreign keys
+            database.execute_sql('PRAGMA foreign_keys = ON')
+        self.people = [Person.create(name=str(i), birthday=datetime.date.today(), is_relative=True)
+                       for i in range(4)]
+        self.people[0].name = 'renamed'
+        self.people[0].save()
+        self.ids = [person.id for person in self.people]
+        for person in self.people[:3]:
+            person.delete_instance()
+
+    def tearDown(self):
+        if not database_url:
+            database.execute_sql('PRAGMA foreign_keys = OFF')
+        Person.drop_table()
+
+    def test_should_create_deleted_indexes(self):
+        VersionModel = Person._VersionModel
+        indexes = [index.columns for index in database.get_indexes(VersionModel._meta.db_table)]
+        self.assertIn(['_record_id', '_version_id'], indexes)
+        self.assertIn(['_deleted', '_valid_until', '_valid_from'], indexes)
+
+    def test_should_keep_record_id_after_delete(self):
+        VersionModel = Person._VersionModel
+        versions = list(VersionModel.select().where(VersionModel._record_id == self.ids[0])
+                        .order_by(VersionModel._version_id))
+        self.assertEqual([version._version_id for version in versions], [1, 2, 3])
+        self.assertEqual([version._original_record_id for version in versions], [None, None, None])
+
+    def test_deleted_should_return_tombstones(self):
+        deleted = Person.deleted().order_by(Person._VersionModel._record_id)
+        self.assertEqual([version._record_id for version in deleted], self.ids[:3])
+        self.assertEqual([version.name for version in deleted], ['renamed', '1', '2'])
+
+    def test_deleted_should_filter(self):
+        VersionModel = Person._VersionModel
+        VersionModel.update(_valid_from=datetime.datetime(2016, 4, 24)).where(
+            VersionModel._record_id == self.ids[1]).execute()
+        deleted = Person.deleted().where(VersionModel._valid_from > datetime.datetime(2016, 4, 25))
+        self.assertEqual(sorted(version._record_id for version in deleted), [self.ids[0], self.ids[2]])
+
+    def test_deleted_should_skip_reused_ids(self):
+        Person.create(id=self.ids[1], name='new', birthday=datetime.date.today(), is_relative=False)
+        self.assertEqual(sorted(version._record_id for version in Person.deleted()), [self.ids[0], self.ids[2]])
+
+    def test_undelete_should_restore_records(self):
+        restored = Person.undelete([self.ids[0], self.ids[1], self.ids[3], 1000], batch_size=1)
+        self.assertEqual(restored, 2)
+        self.assertEqual([version._record_id for version in Person.deleted()], [self.ids[2]])
+
+        person = Person.get(Person.id == self.ids[0])
+        self.assertEqual(person.name, 'renamed')
+        self.assertEqual(person.version_id, 4)
+        self.assertEqual(Person.get(Person.id == self.ids[1]).name, '1')
+        self.assertEqual(Person.get(Person.id == self.ids[3]).name, '3')
+
+        # the restored record carries on as usual
+        person.name = 'again'
+        person.save()
+        versions = person.get_versions()
+        self.assertEqual([version._version_id for version in versions], [1, 2, 3, 4, 5])
+        self.assertEqual(versions[3]._valid_until, versions[4]._valid_from)
+        self.assertEqual(person.get_version(1).name, '0')
+        person.revert(-2)
+        self.assertEqual(person.name, 'renamed')
+
+    def test_undelete_should_end_tombstone(self):
+        Person.undelete([self.ids[2]])
+        VersionModel = Person._VersionModel
+        tombstone, restored = (VersionModel.select()
+                               .where(VersionModel._record_id == self.ids[2])
+                               .order_by(VersionModel._version_id))[1:]
+        self.assertTrue(tombstone._deleted)
+        self.assertEqual(tombstone._valid_until, restored._valid_from)
+        self.assertFalse(restored._deleted)
+        self.assertIsNone(restored._valid_until)
+        self.assertEqual(restored._original_record_id, self.ids[2])
+
+    def test_undelete_should_not_restore_twice(self):
+        self.assertEqual(Person.undelete(self.ids), 3)
+        self.assertEqual(Person.undelete(self.ids), 0)
+        self.assertEqual(Person.select().count(), 4)
+
+
 class School(BaseClass):
     name = CharField()
 
@@ -293,5 +512,41 @@ class TestRelations(unittest.TestCase):
         self.assertEqual(self.student2.school, self.school)
 
 
+class TestLazyVersionModel(unittest.TestCase):
+
+    def define_model(self):
+        class Animal(BaseClass):
+            name = CharField()
+        return Animal
+
+    def test_should_not_build_version_model_on_definition(self):
+        Animal = self.define_model()
+        self.assertIsInstance(vars(Animal)['_VersionModel'], _LazyVersionModel)
+        self.assertFalse(Animal._is_version_model())
+        self.assertIsInstance(vars(Animal)['_VersionModel'], _LazyVersionModel)
+
+    def test_should_build_version_model_once_on_access(self):
+        Animal = self.define_model()
+        VersionModel = Animal._VersionModel
+        self.assertTrue(issubclass(VersionModel, Animal))
+        self.assertIs(vars(Animal)['_VersionModel'], VersionModel)
+        self.assertIs(Animal._VersionModel, VersionModel)
+        self.assertTrue(VersionModel._is_version_model())
+
+    def test_should_build_version_model_on_versions_access(self):
+        Animal = self.define_model()
+        Animal.create_table()
+        try:
+            animal = Animal.create(name='cat')
+            self.assertEqual([version.name for version in animal._versions], ['cat'])
+            self.assertIs(Animal._versions.field.model_class, Animal._VersionModel)
+        finally:
+            Animal.drop_table()
+
+    def test_should_build_version_model_on_versions_access_before_anything_else(self):
+        Animal = self.define_model()
+        self.assertIs(Animal._versions.field.model_class, Animal._VersionModel)
+
+
 if __name__ == '__main__':
     unittest.main()